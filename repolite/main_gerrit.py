@@ -33,7 +33,7 @@ import subprocess
 
 from repolite.util.log import fatalError
 from repolite.util.misc import FatalError
-from repolite.vcs import gerrit
+from repolite.vcs import gerrit, git
 
 
 class Gerrit:
@@ -44,7 +44,8 @@ class Gerrit:
         oMethod = getattr(self, self.oArgs.command.upper())
         if oMethod is not None and callable(oMethod):
             try:
-                return oMethod()
+                with git.repoStateCache(), git.catFilePool():
+                    return oMethod()
             except (subprocess.CalledProcessError, OSError) as e:
                 raise FatalError(e)
         raise FatalError("Command %s is not implemented." % self.oArgs.command)
@@ -53,11 +54,14 @@ class Gerrit:
         gerrit.push(sTopic=self.oArgs.topic, sTargetBranch=self.oArgs.branch)
 
     def DOWNLOAD(self):
-        oMatch = re.match(r"(\d+)/\d+", self.oArgs.patch)
-        if oMatch is None:
-            raise FatalError("%s is not a valid patch ID" % self.oArgs.patch)
-        sPatchChecksum = "%02d" % int(oMatch.group(1)[-2:])
-        gerrit.download("refs/changes/%s/%s" % (sPatchChecksum, self.oArgs.patch), bDetach=self.oArgs.detach)
+        lPatchRefs = []
+        for sPatch in self.oArgs.patch:
+            oMatch = re.match(r"(\d+)/\d+", sPatch)
+            if oMatch is None:
+                raise FatalError("%s is not a valid patch ID" % sPatch)
+            sPatchChecksum = "%02d" % int(oMatch.group(1)[-2:])
+            lPatchRefs.append("refs/changes/%s/%s" % (sPatchChecksum, sPatch))
+        gerrit.download(lPatchRefs, bDetach=self.oArgs.detach)
 
     def REBASE(self):
         gerrit.rebase(self.oArgs.branch)
@@ -82,7 +86,7 @@ def parseArgs():
     oPushParser.add_argument("topic", help="Target topic", nargs="?")
 
     oDownloadParser = oSubparsers.add_parser("download", help="Download a patch and rebase on it")
-    oDownloadParser.add_argument("patch", help="Patch ID")
+    oDownloadParser.add_argument("patch", help="Patch IDs, all fetched at once", nargs="+")
     oDownloadParser.add_argument("-d", "--detach", help="Detaches HEAD instead of rebasing", action="store_true")
 
     oRebaseParser = oSubparsers.add_parser("rebase", help="Rebase the current branch on another (local) one")
@@ -28,20 +28,26 @@ __email__ = "cokie.forever@gmail.com"
 __license__ = "MIT"
 
 import argparse
+import asyncio
 import inspect
 import json
 import os
 import shlex
+import sqlite3
 import subprocess
+import sys
+import threading
 from collections import OrderedDict, Counter
-from configparser import ConfigParser
-from urllib.parse import urlparse, unquote
+from urllib.parse import quote_plus
 
 import requests
 
+from repolite.manifest import Manifest, parseCloneOptions
+from repolite.util import config
 from repolite.util.log import error, warning, highlight, fatalError, success, fullSuccess, oTerminal
-from repolite.util.misc import strOrDefault, FatalError, changeWorkingDir, hideFile
-from repolite.vcs import gerrit, git
+from repolite.util.misc import strOrDefault, FatalError, hideFile, workingDir, getWorkingDir, run
+from repolite.util.parallel import runInParallel
+from repolite.vcs import agit, gerrit, git, ssh
 
 
 def KeepInvalid(xFunction):
@@ -55,28 +61,87 @@ def ForAll(xFunction):
 
 
 class RepoData:
-    def __init__(self):
-        self.dRaw = {}
+    """Data of the tool about the repos, stored in a SQLite database.
 
-    def load(self, sFile):
+    Each value is written on its own as soon as it is set, so that nothing is lost if the tool is interrupted, and
+    the WAL journal allows several threads or processes to read and write the database at the same time. Each thread
+    has its own connection.
+    """
+
+    def __init__(self, sFile):
+        self.sFile = sFile
+        self.oConnections = threading.local()
+
+    def getConnection(self):
+        oConnection = getattr(self.oConnections, "oConnection", None)
+        if oConnection is None:
+            try:
+                # Autocommit, transactions are explicit
+                oConnection = sqlite3.connect(self.sFile, timeout=30, isolation_level=None)
+                oConnection.execute("PRAGMA journal_mode=WAL")
+                oConnection.execute("CREATE TABLE IF NOT EXISTS pushed (project TEXT NOT NULL, change_id TEXT NOT NULL,"
+                                    " commit_id TEXT NOT NULL, PRIMARY KEY (project, change_id))")
+                oConnection.execute("CREATE TABLE IF NOT EXISTS synced (project TEXT NOT NULL PRIMARY KEY,"
+                                    " commit_id TEXT NOT NULL)")
+            except sqlite3.Error as e:
+                raise FatalError("Unable to open %s: %s" % (self.sFile, e))
+            self.oConnections.oConnection = oConnection
+        return oConnection
+
+    def execute(self, sQuery, tParams=()):
         try:
-            with open(sFile, "r") as oFile:
-                self.dRaw = json.load(oFile)
-        except (ValueError, OSError) as e:
-            raise FatalError(e)
+            return self.getConnection().execute(sQuery, tParams).fetchall()
+        except sqlite3.Error as e:
+            raise FatalError("Unable to access %s: %s" % (self.sFile, e))
 
-    def save(self, sFile):
+    def executeMany(self, sQuery, lParams):
+        oConnection = self.getConnection()
+        try:
+            with oConnection:
+                oConnection.execute("BEGIN IMMEDIATE")
+                oConnection.executemany(sQuery, lParams)
+        except sqlite3.Error as e:
+            raise FatalError("Unable to write to %s: %s" % (self.sFile, e))
+
+    def importJson(self, sJsonFile):
+        """Imports the data of the former JSON file, without overwriting anything"""
         try:
-            with open(sFile, "w") as oFile:
-                json.dump(self.dRaw, oFile)
+            with open(sJsonFile, "r") as oFile:
+                dRaw = json.load(oFile)
         except (ValueError, OSError) as e:
             raise FatalError(e)
+        lPushed, lSynced = [], []
+        for sProject, dProjectData in dRaw.items():
+            for sKey, xValue in dProjectData.items():
+                if sKey == "last-synced-commit":
+                    lSynced.append((sProject, xValue))
+                elif isinstance(xValue, dict) and xValue.get("last-pushed-commit"):
+                    lPushed.append((sProject, sKey, xValue["last-pushed-commit"]))
+        self.executeMany("INSERT OR IGNORE INTO pushed VALUES (?, ?, ?)", lPushed)
+        self.executeMany("INSERT OR IGNORE INTO synced VALUES (?, ?)", lSynced)
 
     def getLastPushedCommit(self, sProject, sChangeId):
-        return self.dRaw.get(sProject, {}).get(sChangeId, {}).get("last-pushed-commit")
+        lRows = self.execute("SELECT commit_id FROM pushed WHERE project = ? AND change_id = ?", (sProject, sChangeId))
+        return lRows[0][0] if lRows else None
+
+    def getAllLastPushedCommits(self):
+        return {(sProject, sChangeId): sCommit
+                for sProject, sChangeId, sCommit in self.execute("SELECT project, change_id, commit_id FROM pushed")}
 
     def setLastPushedCommit(self, sProject, sChangeId, sCommit):
-        self.dRaw.setdefault(sProject, {}).setdefault(sChangeId, {})["last-pushed-commit"] = sCommit
+        self.setLastPushedCommits({(sProject, sChangeId): sCommit})
+
+    def setLastPushedCommits(self, dCommits):
+        """Sets several last pushed commits, by project and Change-Id, at once"""
+        self.executeMany("INSERT OR REPLACE INTO pushed VALUES (?, ?, ?)",
+                         [(sProject, sChangeId, sCommit) for (sProject, sChangeId), sCommit in dCommits.items()])
+
+    def getAllLastSyncedCommits(self):
+        return dict(self.execute("SELECT project, commit_id FROM synced"))
+
+    def setLastSyncedCommits(self, dCommits):
+        """Sets the last synced commits of several projects at once"""
+        self.executeMany("INSERT OR REPLACE INTO synced VALUES (?, ?)", list(dCommits.items()))
 
 
 class RepoLite:
@@ -84,44 +149,59 @@ class RepoLite:
         self.oArgs = oArgs
         self.oApiClient = None
         self.sRootFolder = os.path.abspath(os.getcwd())
-        self.sRepoDataFile = os.path.join(self.sRootFolder, ".repolite", "data")
+        self.sRepoDataFile = os.path.join(self.sRootFolder, ".repolite", "data.sqlite")
+        self.oRepoData = None
+        self.oRepoDataLock = threading.Lock()
+        self.oApiClientLock = threading.Lock()
+        self.oManifest = None
+        self.dTopics = {}
 
     def getApiClient(self):
-        sConfigFilePath = os.path.join(os.path.expanduser("~"), ".repolite")
-        if not os.path.isfile(sConfigFilePath):
-            raise FatalError("The config file %s does not exist." % sConfigFilePath)
-
-        sWorkingDir = os.path.normcase(os.path.abspath(os.path.dirname(os.getcwd())))
-        oConfig = ConfigParser()
-        oConfig.read(sConfigFilePath)
-        dSection = oConfig["DEFAULT"]
-        for sSection in oConfig.sections():
-            sTarget = oConfig.get(sSection, "target", fallback=None)
-            if sTarget:
-                sTarget = os.path.normcase(os.path.abspath(os.path.join(os.path.dirname(sConfigFilePath), sTarget)))
-                if sWorkingDir == sTarget:
-                    dSection = oConfig[sSection]
-                    break
-
-        def getNotEmpty(sKey):
-            sValue = dSection.get(sKey, fallback=None)
-            if sValue is None:
-                raise FatalError("No value provided for %s in the config file" % sKey)
-            return sValue
-
-        self.oApiClient = gerrit.ApiClient(getNotEmpty("url"), getNotEmpty("username"), getNotEmpty("password"))
-        return self.oApiClient
+        # A single client for all the threads, so that the connections to Gerrit are reused
+        with self.oApiClientLock:
+            if self.oApiClient is None:
+                self.oApiClient = self.createApiClient()
+            return self.oApiClient
+
+    def createApiClient(self):
+        oSettings = self.getSettings()
+        oCache = None
+        if oSettings.getBool("cache"):
+            sDataFolder = os.path.dirname(self.sRepoDataFile)
+            os.makedirs(sDataFolder, exist_ok=True)
+            hideFile(sDataFolder)
+            oCache = gerrit.ResponseCache(os.path.join(sDataFolder, "cache"), iTtl=oSettings.getInt("cache_ttl", 0),
+                                          iMaxSize=oSettings.getInt("cache_size", 50) * 1024 * 1024)
+
+        return gerrit.ApiClient(oSettings.getRequired("url"), oSettings.getRequired("username"),
+                                oSettings.getRequired("password"), oCache=oCache,
+                                iPoolSize=oSettings.getInt("pool_size", max(10, self.oArgs.jobs)),
+                                fTimeout=oSettings.getFloat("timeout", 30),
+                                iRetries=oSettings.getInt("retries", 3),
+                                fBackoffFactor=oSettings.getFloat("retry_backoff", 0.5))
+
+    def getSettings(self):
+        return config.getSettings(self.sRootFolder)
 
     def run(self):
         oMethod = getattr(self, self.oArgs.command.upper())
         if oMethod is not None and callable(oMethod):
-            return self.executeForAll(oMethod)
+            oSettings = self.getSettings()
+            git.setFetchProfile(git.FetchProfile(bProtocolV2=oSettings.getBool("fetch_protocol_v2", True),
+                                                 bTags=oSettings.getBool("fetch_tags", False),
+                                                 sNegotiationTip=oSettings.get("fetch_negotiation_tip", "HEAD")))
+            with git.repoStateCache(), git.catFilePool(), \
+                    ssh.connectionSharing(oSettings.getBool("ssh_connection_sharing", True)):
+                return self.executeForAll(oMethod)
         raise FatalError("Command %s is not implemented." % self.oArgs.command)
 
     def executeForAll(self, xFunction):
         dRepos = self.readManifest(bKeepInvalid=getattr(xFunction, "bKeepInvalid", False))
         if not dRepos:
             raise FatalError("There is no valid repository defined.")
+        dRepos = self.filterRepos(dRepos)
+        if not dRepos:
+            raise FatalError("No repository matches the given filters.")
         if getattr(xFunction, "bForAll", False):
             return xFunction(dRepos)
         else:
@@ -133,121 +213,369 @@ class RepoLite:
 
             return self.runInRepos(dRepos, doCallFunction)
 
-    def runInRepos(self, dRepos, xFunction, bPrint=True, bCheckTopic=True):
-        if bCheckTopic:
-            lBranches = set()
+    def getTopics(self, dRepos):
+        """Returns the current topic of each existing repo by directory, "(none)" if HEAD is detached. The result is
+        kept, so that the commands do not have to read it again after the consistency check."""
+        lDirPaths = [sDirPath for sDirPath in dRepos.values()
+                     if sDirPath not in self.dTopics and os.path.isdir(sDirPath)]
+        # Most of the time the HEAD file can be read directly, git is only needed for unusual layouts
+        lUnknownDirPaths = []
+        for sDirPath in lDirPaths:
+            sBranch = git.readCurrentBranch(sDirPath)
+            if sBranch is None:
+                lUnknownDirPaths.append(sDirPath)
+            else:
+                self.dTopics[sDirPath] = strOrDefault(sBranch, "(none)")
+
+        async def getUnknownTopics():
+            return await asyncio.gather(*[agit.getCurrentBranch(sCwd=sDirPath) for sDirPath in lUnknownDirPaths])
+
+        if lUnknownDirPaths:
             try:
-                for sDirPath in dRepos.values():
-                    if os.path.isdir(sDirPath):
-                        with changeWorkingDir(sDirPath):
-                            lBranches.add(strOrDefault(git.getCurrentBranch(), "(none)"))
+                for sDirPath, sBranch in zip(lUnknownDirPaths, agit.runAsync(getUnknownTopics())):
+                    self.dTopics[sDirPath] = strOrDefault(sBranch, "(none)")
             except (subprocess.CalledProcessError, OSError) as e:
                 raise FatalError(e)
+        return OrderedDict((sDirPath, self.dTopics[sDirPath]) for sDirPath in dRepos.values()
+                           if sDirPath in self.dTopics)
 
-            if len(lBranches) > 1:
-                warning("Topic is not consistent across your repositories. "
-                        "Found following topics: %s" % ", ".join(lBranches))
-                sInput = input("Do you wish to proceed anyway? (y/n): ")
-                if sInput != "y":
-                    raise FatalError("Operation cancelled")
+    def checkTopic(self, dRepos):
+        lBranches = list(OrderedDict.fromkeys(self.getTopics(dRepos).values()))
 
-        lErrorRepos = []
-        for sRepoUrl, sDirPath in dRepos.items():
+        if len(lBranches) > 1:
+            warning("Topic is not consistent across your repositories. "
+                    "Found following topics: %s" % ", ".join(lBranches))
+            sInput = input("Do you wish to proceed anyway? (y/n): ")
+            if sInput != "y":
+                raise FatalError("Operation cancelled")
+
+    def runInRepos(self, dRepos, xFunction, bPrint=True, bCheckTopic=True):
+        if bCheckTopic:
+            self.checkTopic(dRepos)
+
+        def runInRepo(sRepoUrl):
+            sDirPath = dRepos[sRepoUrl]
             sRepoName = os.path.basename(sDirPath)
             try:
                 os.makedirs(sDirPath, exist_ok=True)
-                with changeWorkingDir(sDirPath):
-                    if bPrint:
-                        highlight("\n### %s ###" % os.path.basename(os.getcwd()))
-                    xFunction(sRepoUrl)
-                    if bPrint:
-                        success("Done")
+                with workingDir(sDirPath):
+                    try:
+                        if bPrint:
+                            highlight("\n### %s ###" % sRepoName)
+                        xFunction(sRepoUrl)
+                        if bPrint:
+                            success("Done")
+                    finally:
+                        # The repo is not visited again by this call
+                        git.closeCatFile()
             except (subprocess.CalledProcessError, FatalError, OSError) as e:
                 error("[%s] %s" % (sRepoName, e))
-                lErrorRepos.append(sDirPath)
-        return lErrorRepos
+                return False
+            return True
+
+        lResults = runInParallel(dRepos, runInRepo, self.oArgs.jobs)
+        return [sDirPath for sDirPath, bSuccess in zip(dRepos.values(), lResults) if not bSuccess]
+
+    def runInReposAsync(self, dRepos, xCoroutineFunction, iJobs=None, bFailFast=False):
+        """Asynchronous alternative to runInRepos, for commands which only need to run a few processes per repo.
+
+        xCoroutineFunction is called with the URL and the directory of each repo, and at most iJobs repos (no limit
+        if None) are processed at the same time. Contrary to runInRepos, it does not print anything except errors.
+        With bFailFast, the processing of all repos is stopped as soon as one fails, and the repos still waiting for
+        their turn are not processed at all.
+        """
+        async def runInRepo(oSemaphore, oStopEvent, sRepoUrl, sDirPath):
+            async with oSemaphore:
+                if oStopEvent.is_set():
+                    return False
+                try:
+                    await xCoroutineFunction(sRepoUrl, sDirPath)
+                except Exception as e:
+                    # Set before releasing the semaphore, so that no other repo is started in the meantime
+                    if bFailFast:
+                        oStopEvent.set()
+                    if isinstance(e, (subprocess.CalledProcessError, FatalError, OSError)):
+                        error("[%s] %s" % (os.path.basename(sDirPath), e))
+                    else:
+                        # Reported like the others instead of stopping all repos
+                        error("[%s] Unexpected error: %r" % (os.path.basename(sDirPath), e))
+                    return False
+                return True
+
+        async def runInAllRepos():
+            oSemaphore = asyncio.Semaphore(iJobs or max(len(dRepos), 1))
+            oStopEvent = asyncio.Event()
+            lTasks = [asyncio.ensure_future(runInRepo(oSemaphore, oStopEvent, sRepoUrl, sDirPath))
+                      for sRepoUrl, sDirPath in dRepos.items()]
+            if bFailFast:
+                for oFuture in asyncio.as_completed(lTasks):
+                    if not await oFuture:
+                        warning("Stopping after the first failure.")
+                        for oTask in lTasks:
+                            oTask.cancel()
+                        break
+            # The repos which could not be processed because of a failure elsewhere count as failed
+            return [xResult is True for xResult in await asyncio.gather(*lTasks, return_exceptions=True)]
+
+        lResults = agit.runAsync(runInAllRepos())
+        return [sDirPath for sDirPath, bSuccess in zip(dRepos.values(), lResults) if not bSuccess]
+
+    def getManifest(self):
+        if self.oManifest is None:
+            self.oManifest = Manifest.load(self.oArgs.manifest, self.sRootFolder,
+                                           os.path.join(self.sRootFolder, ".repolite", "manifest"))
+        return self.oManifest
 
     def readManifest(self, bKeepInvalid=False):
-        if not os.path.isfile(self.oArgs.manifest):
-            raise FatalError("The manifest file %s does not exist." % self.oArgs.manifest)
+        oManifest = self.getManifest()
+        setExistingDirs = oManifest.getExistingDirs() if not bKeepInvalid else None
         dRepos = OrderedDict()
+        for oEntry in oManifest.lEntries:
+            if not bKeepInvalid and oEntry.sDirPath not in setExistingDirs:
+                warning("Directory %s does not exist, skipped." % oEntry.sDirPath)
+            else:
+                dRepos[oEntry.sRepoUrl] = oEntry.sDirPath
+        return dRepos
+
+    def filterRepos(self, dRepos):
+        """Keeps the repos selected with the --only, --group and --changed-since options"""
+        oManifest = self.getManifest()
+        if self.oArgs.only:
+            setSelected = set()
+            for sName in splitList(self.oArgs.only):
+                # Either a project or a directory
+                lEntries = oManifest.getByProject(sName) or [oManifest.getByDir(os.path.join(self.sRootFolder, sName))]
+                if lEntries == [None]:
+                    raise FatalError("Unknown repository: %s" % sName)
+                setSelected.update(oEntry.sRepoUrl for oEntry in lEntries)
+            dRepos = OrderedDict((sRepoUrl, sDirPath) for sRepoUrl, sDirPath in dRepos.items()
+                                 if sRepoUrl in setSelected)
+        if self.oArgs.group:
+            setSelected = set()
+            for sGroup in splitList(self.oArgs.group):
+                lEntries = oManifest.getByGroup(sGroup)
+                if not lEntries:
+                    raise FatalError("Unknown group: %s" % sGroup)
+                setSelected.update(oEntry.sRepoUrl for oEntry in lEntries)
+            dRepos = OrderedDict((sRepoUrl, sDirPath) for sRepoUrl, sDirPath in dRepos.items()
+                                 if sRepoUrl in setSelected)
+        if self.oArgs.changed_since:
+            dRepos = self.getChangedRepos(dRepos, self.oArgs.changed_since)
+        return dRepos
+
+    def getChangedRepos(self, dRepos, sSince):
+        """Returns the repos with commits more recent than sSince (any date understood by git log --since) in HEAD"""
+        async def hasChanged(sDirPath):
+            if not os.path.isdir(os.path.join(sDirPath, ".git")):
+                return False
+            oProcess = await agit.run(["git", "log", "-1", "--format=%H", "--since=%s" % sSince, "HEAD"],
+                                      sCwd=sDirPath)
+            return oProcess.returncode == 0 and bool(oProcess.stdout.strip())
+
+        async def checkAllRepos():
+            return await asyncio.gather(*[hasChanged(sDirPath) for sDirPath in dRepos.values()])
+
         try:
-            with open(self.oArgs.manifest) as oFile:
-                for sLine in oFile:
-                    sLine = sLine.strip()
-                    if sLine:
-                        lElements = sLine.split(" ")
-                        (sRepoUrl, sDirPath) = lElements[0], " ".join(lElements[1:])
-                        if not sDirPath:
-                            sDirPath = unquote(urlparse(sRepoUrl, allow_fragments=True).path.split("/")[-1])
-                        sDirPath = os.path.join(self.sRootFolder, sDirPath)
-                        if not bKeepInvalid and not os.path.isdir(sDirPath):
-                            warning("Directory %s does not exist, skipped." % sDirPath)
-                        else:
-                            dRepos[sRepoUrl] = sDirPath
+            lChanged = agit.runAsync(checkAllRepos())
         except OSError as e:
             raise FatalError(e)
-        return dRepos
+        return OrderedDict((sRepoUrl, sDirPath) for (sRepoUrl, sDirPath), bChanged in zip(dRepos.items(), lChanged)
+                           if bChanged)
 
     def getRepoData(self):
-        oRepoData = RepoData()
-        if os.path.isfile(self.sRepoDataFile):
-            oRepoData.load(self.sRepoDataFile)
-        return oRepoData
+        with self.oRepoDataLock:
+            if self.oRepoData is None:
+                self.oRepoData = self.openRepoData()
+            return self.oRepoData
 
-    def saveRepoData(self, oRepoData):
+    def openRepoData(self):
         sDir = os.path.dirname(self.sRepoDataFile)
-        os.makedirs(sDir, exist_ok=True)
-        hideFile(sDir)
-        oRepoData.save(self.sRepoDataFile)
+        try:
+            os.makedirs(sDir, exist_ok=True)
+            hideFile(sDir)
+        except OSError as e:
+            raise FatalError(e)
+        oRepoData = RepoData(self.sRepoDataFile)
+        # The data used to be stored in a JSON file
+        sJsonFile = os.path.join(sDir, "data")
+        if os.path.isfile(sJsonFile):
+            oRepoData.importJson(sJsonFile)
+            try:
+                os.replace(sJsonFile, sJsonFile + ".bak")
+            except OSError:
+                # Already done by another process
+                pass
+        return oRepoData
 
+    def getCloneOptions(self, sRepoUrl):
+        # The options of the manifest take precedence over the ones of the command line
+        lArgs = []
+        if self.oArgs.depth is not None:
+            lArgs.append("--depth=%d" % self.oArgs.depth)
+        if self.oArgs.filter is not None:
+            lArgs.append("--filter=%s" % self.oArgs.filter)
+        if self.oArgs.single_branch:
+            lArgs.append("--single-branch")
+        dOptions = parseCloneOptions(lArgs)
+        dOptions.update(parseCloneOptions(self.getManifest().getByUrl(sRepoUrl).lCloneOptions))
+        return list(dOptions.values())
+
+    def getMirrorFolder(self):
+        if self.oArgs.mirror:
+            return os.path.abspath(self.oArgs.mirror)
+        sMirrorFolder = self.getSettings().get("mirror")
+        if sMirrorFolder:
+            # Relative to the config file, like the targets
+            return os.path.abspath(os.path.join(os.path.dirname(config.getConfigFilePath()),
+                                                os.path.expanduser(sMirrorFolder)))
+        return None
+
+    def getUpToDateRepos(self, dRepos, dProjects, oRepoData):
+        """Returns the repos whose remote HEAD did not move since their last sync, and which are still based on it"""
+        setUpToDate = set()
+        dLastSyncedCommits = oRepoData.getAllLastSyncedCommits()
+
+        async def checkRepo(sRepoUrl, sDirPath):
+            sLastSyncedCommit = dLastSyncedCommits.get(dProjects[sRepoUrl])
+            if not sLastSyncedCommit or not os.path.isdir(os.path.join(sDirPath, ".git")):
+                return
+            try:
+                sRemote = await agit.getFirstRemote(sCwd=sDirPath)
+                oProcess = await agit.run(["git"] + git.getFetchConfigArgs() + ["ls-remote", sRemote, "HEAD"],
+                                          sCwd=sDirPath, check=True)
+                if oProcess.stdout.split()[:1] != [sLastSyncedCommit]:
+                    return
+                if self.oArgs.detach:
+                    bUpToDate = await agit.getLastCommit(sCwd=sDirPath) == sLastSyncedCommit
+                else:
+                    oProcess = await agit.run(["git", "merge-base", "--is-ancestor", sLastSyncedCommit, "HEAD"],
+                                              sCwd=sDirPath)
+                    bUpToDate = oProcess.returncode == 0
+            except (subprocess.CalledProcessError, OSError):
+                # The sync itself will report the problem, if any
+                return
+            if bUpToDate:
+                setUpToDate.add(sRepoUrl)
+
+        async def checkAllRepos():
+            await asyncio.gather(*[checkRepo(sRepoUrl, sDirPath) for sRepoUrl, sDirPath in dRepos.items()])
+
+        agit.runAsync(checkAllRepos())
+        return setUpToDate
+
+    @ForAll
     @KeepInvalid
-    def SYNC(self, sRepoUrl):
-        if not os.path.isdir(".git"):
+    def SYNC(self, dRepos):
+        self.checkTopic(dRepos)
+        oRepoData = self.getRepoData()
+        dProjects = {sRepoUrl: self.getManifest().getByUrl(sRepoUrl).sProject for sRepoUrl in dRepos}
+        setUpToDate = set() if self.oArgs.full else self.getUpToDateRepos(dRepos, dProjects, oRepoData)
+        dSyncedCommits = {}
+
+        def sync(sRepoUrl):
+            if sRepoUrl in setUpToDate:
+                print("Already up-to-date with %s" % sRepoUrl)
+            else:
+                dSyncedCommits[dProjects[sRepoUrl]] = self.syncRepo(sRepoUrl)
+
+        try:
+            return self.runInRepos(dRepos, sync, bCheckTopic=False)
+        finally:
+            # Saved once for all repos
+            if dSyncedCommits:
+                oRepoData.setLastSyncedCommits(dSyncedCommits)
+
+    def syncRepo(self, sRepoUrl):
+        """Syncs the current repo, returns the commit of the remote it was synced with"""
+        if not os.path.isdir(os.path.join(getWorkingDir(), ".git")):
+            lOptions = self.getCloneOptions(sRepoUrl)
+            sMirrorFolder = self.getMirrorFolder()
+            if sMirrorFolder:
+                print("Updating mirror of %s" % sRepoUrl)
+                try:
+                    lOptions += ["--reference-if-able", git.updateMirror(sMirrorFolder, sRepoUrl)]
+                except subprocess.CalledProcessError:
+                    warning("Unable to update the mirror, cloning without it.")
             print("Cloning from %s" % sRepoUrl)
-            subprocess.run(["git", "clone", sRepoUrl, "."], check=True)
+            git.clone(sRepoUrl, ".", lOptions)
             sCurrentBranch = git.getCurrentBranch()
-            subprocess.run(["git", "checkout", "HEAD", "--detach"], check=True)
-            subprocess.run(["git", "branch", "-d", sCurrentBranch], check=True)
+            run(["git", "checkout", "HEAD", "--detach"], check=True)
+            run(["git", "branch", "-d", sCurrentBranch], check=True)
+            return git.getLastCommit()
+
+        print("Syncing from %s" % sRepoUrl)
+        sRemote = git.getFirstRemote()
+        sFetchedCommit = git.fetch(sRemote, "HEAD")
+        if self.oArgs.detach:
+            run(["git", "checkout", sFetchedCommit, "--detach"], check=True)
         else:
-            print("Syncing from %s" % sRepoUrl)
-            subprocess.run(["git", "fetch", git.getFirstRemote(), "HEAD"], check=True)
-            if self.oArgs.detach:
-                subprocess.run(["git", "checkout", "FETCH_HEAD", "--detach"], check=True)
-            else:
-                gerrit.rebase("FETCH_HEAD", bIgnoreChangeIds=True)
+            git.deepenUntilMergeBase(sRemote, "HEAD", sFetchedCommit)
+            gerrit.rebase(sFetchedCommit, bIgnoreChangeIds=True)
+        return sFetchedCommit
 
     def START(self):
         print("Creating new topic: %s -> %s" % (strOrDefault(git.getCurrentBranch(), "(none)"), self.oArgs.topic))
-        subprocess.run(["git", "checkout", "-b", self.oArgs.topic], check=True)
+        run(["git", "checkout", "-b", self.oArgs.topic], check=True)
 
     def SWITCH(self):
         print("Switching topic: %s -> %s" % (strOrDefault(git.getCurrentBranch(), "(none)"), self.oArgs.topic))
-        subprocess.run(["git", "checkout", self.oArgs.topic], check=True)
+        run(["git", "checkout", self.oArgs.topic], check=True)
 
     def END(self):
         if git.getCurrentBranch() == self.oArgs.topic:
             print("Detaching HEAD")
-            subprocess.run(["git", "fetch", git.getFirstRemote(), "HEAD"], check=True)
-            subprocess.run(["git", "checkout", "FETCH_HEAD", "--detach"], check=True)
+            run(["git", "checkout", git.fetch(git.getFirstRemote(), "HEAD"), "--detach"], check=True)
         print("Deleting topic %s" % self.oArgs.topic)
-        subprocess.run(["git", "branch", "-D", self.oArgs.topic], check=True)
-
-    def FORALL(self):
-        print("Running command")
-        subprocess.run(shlex.split(self.oArgs.command_line), check=True)
+        run(["git", "branch", "-D", self.oArgs.topic], check=True)
 
     @ForAll
-    def TOPIC(self, dRepos):
-        dTopics = OrderedDict()
+    def FORALL(self, dRepos):
+        self.checkTopic(dRepos)
+        lArgs = shlex.split(self.oArgs.command_line)
+        # With a single job the command can use the terminal directly, which allows interactive commands
+        bCapture = self.oArgs.jobs > 1
+
+        def printHeader(sDirPath):
+            highlight("\n### %s ###" % os.path.basename(sDirPath))
+            print("Running command")
+
+        async def runCommand(sRepoUrl, sDirPath):
+            dEnv = os.environ.copy()
+            dEnv["REPO_PROJECT"] = self.getManifest().getByUrl(sRepoUrl).sProject
+            dEnv["REPO_PATH"] = os.path.relpath(sDirPath, self.sRootFolder)
+            if not bCapture:
+                printHeader(sDirPath)
+                sys.stdout.flush()
+                iReturnCode = (await agit.run(lArgs, sCwd=sDirPath, bCapture=False, env=dEnv)).returncode
+            elif self.oArgs.group_output:
+                oProcess = await agit.run(lArgs, sCwd=sDirPath, bMergeOutput=True, env=dEnv)
+                printHeader(sDirPath)
+                if oProcess.stdout:
+                    print(oProcess.stdout, end="" if oProcess.stdout.endswith("\n") else "\n")
+                iReturnCode = oProcess.returncode
+            else:
+                sPrefix = "[%s] " % os.path.basename(sDirPath)
+                iReturnCode = await agit.stream(lArgs, lambda s: print(sPrefix + s),
+                                                lambda s: print(sPrefix + s, file=sys.stderr), sCwd=sDirPath, env=dEnv)
+            if iReturnCode != 0:
+                raise subprocess.CalledProcessError(iReturnCode, lArgs)
+            if not bCapture or self.oArgs.group_output:
+                success("Done")
+
+        async def forAll(sRepoUrl, sDirPath):
+            if not self.oArgs.timeout:
+                return await runCommand(sRepoUrl, sDirPath)
+            try:
+                await asyncio.wait_for(runCommand(sRepoUrl, sDirPath), self.oArgs.timeout)
+            except asyncio.TimeoutError:
+                raise FatalError("Timed out after %g seconds" % self.oArgs.timeout)
 
-        def topic():
-            sRepoName = os.path.basename(os.getcwd())
-            dTopics[sRepoName] = strOrDefault(git.getCurrentBranch(), "(none)")
+        return self.runInReposAsync(dRepos, forAll, iJobs=self.oArgs.jobs, bFailFast=self.oArgs.fail_fast)
 
-        lErrorRepos = self.runInRepos(dRepos, lambda _: topic(), bPrint=False, bCheckTopic=False)
-        if lErrorRepos:
-            return lErrorRepos
+    @ForAll
+    def TOPIC(self, dRepos):
+        dTopics = OrderedDict((os.path.basename(sDirPath), sTopic)
+                              for sDirPath, sTopic in self.getTopics(dRepos).items())
 
         lTopics = list(set(dTopics.values()))
         if len(lTopics) == 1:
@@ -263,20 +591,97 @@ class RepoLite:
 
         return []
 
-    def PULL(self, sRepoUrl):
-        sChangeId = gerrit.getChangeId()
-        if not sChangeId:
-            raise FatalError("Unable to extract Change-Id")
-        sProject = gerrit.getProjectName()
+    @ForAll
+    def STATUS(self, dRepos):
+        oRepoData = self.getRepoData()
+        dLastSyncedCommits = oRepoData.getAllLastSyncedCommits()
+        dLastPushedCommits = oRepoData.getAllLastPushedCommits()
+        dRows = OrderedDict((sDirPath, None) for sDirPath in dRepos.values())
+
+        async def status(sRepoUrl, sDirPath):
+            oStatus = git.WorktreeStatus((await agit.run(git.getStatusArgs(), sCwd=sDirPath, check=True)).stdout)
+            sProject = self.getManifest().getByUrl(sRepoUrl).sProject
+
+            # Compared to the upstream branch if any, otherwise to the remote commit of the last sync
+            tAheadBehind = oStatus.tAheadBehind
+            sLastSyncedCommit = dLastSyncedCommits.get(sProject)
+            if tAheadBehind is None and sLastSyncedCommit and oStatus.sCommit:
+                oProcess = await agit.run(["git", "rev-list", "--left-right", "--count",
+                                           "%s...HEAD" % sLastSyncedCommit], sCwd=sDirPath)
+                if oProcess.returncode == 0:
+                    iBehind, iAhead = (int(s) for s in oProcess.stdout.split())
+                    tAheadBehind = (iAhead, iBehind)
+
+            sGerritState = "-"
+            if oStatus.sCommit:
+                sChangeId = gerrit.parseChangeId(await agit.getLastCommitMsg(sCwd=sDirPath))
+                if sChangeId:
+                    bPushed = dLastPushedCommits.get((sProject, sChangeId)) == oStatus.sCommit
+                    sGerritState = "pushed" if bPushed else "not pushed"
+
+            sChanges = str(oStatus.iChanged)
+            if oStatus.iConflicts:
+                sChanges += " (%d conflicts)" % oStatus.iConflicts
+            dRows[sDirPath] = [os.path.basename(sDirPath), strOrDefault(oStatus.sBranch, "(none)"), sChanges,
+                               str(oStatus.iUntracked),
+                               "+%d/-%d" % tAheadBehind if tAheadBehind is not None else "-", sGerritState]
+
+        # Read-only, so all repos are processed at once, within the limit of processes of agit
+        lErrorRepos = self.runInReposAsync(dRepos, status)
+        lRows = [["Repo", "Topic", "Changes", "Untracked", "Ahead/Behind", "Gerrit"]]
+        lRows += [lRow for lRow in dRows.values() if lRow is not None]
+        printTable(lRows)
+        return lErrorRepos
+
+    def getChanges(self, dRepos, lAdditionalData):
+        """Returns the (project, Change-Id, commit) of the HEAD of each repo, or the exception raised while getting
+        them, and the data of the corresponding changes found on Gerrit, fetched with as few requests as possible"""
+        dLocalChanges = {}
+
+        def getLocalChange(sRepoUrl):
+            try:
+                sChangeId = gerrit.getChangeId()
+                if not sChangeId:
+                    raise FatalError("Unable to extract Change-Id")
+                dLocalChanges[sRepoUrl] = (gerrit.getProjectName(), sChangeId, git.getRepoState().sCommit)
+            except (subprocess.CalledProcessError, FatalError, OSError) as e:
+                # Reported later on, together with the rest of the output of the repo
+                dLocalChanges[sRepoUrl] = e
+
+        self.runInRepos(dRepos, getLocalChange, bPrint=False)
+        lChanges = [(sProject, "master", sChangeId) for xLocalChange in dLocalChanges.values()
+                    if not isinstance(xLocalChange, Exception) for sProject, sChangeId, _ in [xLocalChange]]
         try:
-            dChangeData = self.getApiClient().getChangeData(sChangeId, sProject, lAdditionalData=["ALL_REVISIONS"])
-        except requests.HTTPError as e:
-            if e.response.status_code == 404:
-                warning("No remote patch")
-                return
-            raise e
+            dChangesData = self.getApiClient().getChangesData(lChanges, lAdditionalData=lAdditionalData)
+        except requests.RequestException as e:
+            raise FatalError("Unable to get the changes from Gerrit: %s" % e)
+        return dLocalChanges, dChangesData
+
+    def runWithChangeData(self, dRepos, xFunction, lAdditionalData):
+        """Runs xFunction(sRepoUrl, sProject, sChangeId, dChangeData) in each repo, dChangeData being None if the change
+        does not exist on Gerrit. The data of all changes is fetched beforehand with as few requests as possible."""
+        dLocalChanges, dChangesData = self.getChanges(dRepos, lAdditionalData)
+
+        def runWithLocalChange(sRepoUrl):
+            xLocalChange = dLocalChanges[sRepoUrl]
+            if isinstance(xLocalChange, Exception):
+                raise xLocalChange
+            sProject, sChangeId, _ = xLocalChange
+            xFunction(sRepoUrl, sProject, sChangeId, dChangesData.get((sProject, "master", sChangeId)))
+
+        return self.runInRepos(dRepos, runWithLocalChange, bCheckTopic=False)
+
+    @ForAll
+    def PULL(self, dRepos):
+        return self.runWithChangeData(dRepos, self.pullRepo, lAdditionalData=["ALL_REVISIONS"])
+
+    def pullRepo(self, sRepoUrl, sProject, sChangeId, dChangeData):
+        if dChangeData is None:
+            warning("No remote patch")
+            return
+        oState = git.getRepoState()
         sRemoteCommit = dChangeData["current_revision"]
-        sLocalCommit = git.getLastCommit()
+        sLocalCommit = oState.sCommit
         sLastPushedCommit = self.getRepoData().getLastPushedCommit(sProject, sChangeId)
         if sRemoteCommit == sLocalCommit:
             print("Already up-to-date.")
@@ -286,89 +691,143 @@ class RepoLite:
             return
         elif sLocalCommit in dChangeData["revisions"]:
             print("Pulling changes from %s" % sRepoUrl)
-            sBranch = git.getCurrentBranch()
+            sBranch = oState.sBranch
             dFetchData = dChangeData["revisions"][sRemoteCommit]["fetch"]["ssh"]
-            subprocess.run(["git", "fetch", dFetchData["url"], dFetchData["ref"]], check=True)
-            subprocess.run(["git", "checkout", "FETCH_HEAD"], check=True)
+            git.invalidateRepoState()
+            run(["git", "checkout", git.fetch(dFetchData["url"], dFetchData["ref"])], check=True)
             if sBranch:
-                subprocess.run(["git", "branch", "-D", sBranch], check=True)
-                subprocess.run(["git", "checkout", "-b", sBranch], check=True)
+                run(["git", "branch", "-D", sBranch], check=True)
+                run(["git", "checkout", "-b", sBranch], check=True)
         else:
             raise FatalError("You have local commits unknown to Gerrit")
 
-    def PUSH(self, sRepoUrl):
-        sChangeId = gerrit.getChangeId()
-        if not sChangeId:
-            raise FatalError("Unable to extract Change-Id")
-        sProject = gerrit.getProjectName()
+    @ForAll
+    def PUSH(self, dRepos):
+        dLocalChanges, dChangesData = self.getChanges(dRepos, lAdditionalData=["CURRENT_REVISION"])
         oRepoData = self.getRepoData()
-        sLocalCommit = git.getLastCommit()
-        try:
-            dChangeData = self.getApiClient().getChangeData(sChangeId, sProject, lAdditionalData=["CURRENT_REVISION"])
-        except requests.HTTPError as e:
-            if e.response.status_code != 404:
-                raise
-        else:
-            sRemoteCommit = dChangeData["current_revision"]
-            sLastPushedCommit = oRepoData.getLastPushedCommit(sProject, sChangeId)
-            if sRemoteCommit == sLocalCommit:
+        dLastPushedCommits = oRepoData.getAllLastPushedCommits()
+
+        # All the checks are done upfront, so that the pushes can then run without interruption
+        setUpToDate = set()
+        lConflicts = []
+        for sRepoUrl, xLocalChange in dLocalChanges.items():
+            if isinstance(xLocalChange, Exception):
+                continue
+            sProject, sChangeId, sLocalCommit = xLocalChange
+            dChangeData = dChangesData.get((sProject, "master", sChangeId))
+            if dChangeData is not None:
+                sRemoteCommit = dChangeData["current_revision"]
+                if sRemoteCommit == sLocalCommit:
+                    setUpToDate.add(sRepoUrl)
+                elif sRemoteCommit != dLastPushedCommits.get((sProject, sChangeId)):
+                    lConflicts.append(sRepoUrl)
+
+        bOverwrite = True
+        if lConflicts:
+            warning("You are about to overwrite unknown changes in %s."
+                    % ", ".join(os.path.basename(dRepos[sRepoUrl]) for sRepoUrl in lConflicts))
+            bOverwrite = input("Continue? (y/n): ") == "y"
+
+        dPushedCommits = {}
+
+        def pushRepo(sRepoUrl):
+            xLocalChange = dLocalChanges[sRepoUrl]
+            if isinstance(xLocalChange, Exception):
+                raise xLocalChange
+            sProject, sChangeId, sLocalCommit = xLocalChange
+            if sRepoUrl in setUpToDate:
                 warning("No new changes")
                 return
-            elif sRemoteCommit != sLastPushedCommit:
-                warning("You are about to overwrite unknown changes.")
-                sInput = input("Continue? (y/n): ")
-                if sInput != "y":
-                    raise FatalError("Operation aborted")
-        print("Pushing changes to %s" % sRepoUrl)
-        gerrit.push()
-        oRepoData.setLastPushedCommit(sProject, sChangeId, sLocalCommit)
-        self.saveRepoData(oRepoData)
+            if sRepoUrl in lConflicts and not bOverwrite:
+                raise FatalError("Operation aborted")
+            print("Pushing changes to %s" % sRepoUrl)
+            gerrit.push()
+            dPushedCommits[(sProject, sChangeId)] = sLocalCommit
+
+        try:
+            return self.runInRepos(dRepos, pushRepo, bCheckTopic=False)
+        finally:
+            # Saved once for all repos
+            if dPushedCommits:
+                oRepoData.setLastPushedCommits(dPushedCommits)
 
     @ForAll
     def DOWNLOAD(self, dRepos):
-        bFound = False
+        if self.oArgs.topic is not None:
+            return self.downloadTopic(dRepos, self.oArgs.topic)
+
+        sId = self.oArgs.change
+        sNumber = None
+        if "/" in sId:
+            sId, sNumber = sId.split("/", maxsplit=1)
+
+        if self.oArgs.project:
+            setProjectUrls = {oEntry.sRepoUrl for oEntry in self.getManifest().getByProject(self.oArgs.project)}
+            dRepos = {sRepoUrl: sDirPath for sRepoUrl, sDirPath in dRepos.items() if sRepoUrl in setProjectUrls}
+            if not dRepos:
+                raise FatalError("No project \"%s\" found." % self.oArgs.project)
+
+        dPatchRefs = self.getPatchRefs(dRepos, "change:%s" % sId, sNumber=sNumber)
+        if not dPatchRefs:
+            if self.oArgs.project:
+                raise FatalError("Change %s not found within this project" % self.oArgs.change)
+            raise FatalError("Change %s was not found in any project." % self.oArgs.change)
+
+        def download(sRepoUrl):
+            print("Downloading change %s from %s" % (self.oArgs.change, sRepoUrl))
+            gerrit.download(dPatchRefs[sRepoUrl][:1], bDetach=self.oArgs.detach)
+
+        # Only the repos containing the change are visited
+        return self.runInRepos({sRepoUrl: sDirPath for sRepoUrl, sDirPath in dRepos.items() if sRepoUrl in dPatchRefs},
+                               download)
+
+    def downloadTopic(self, dRepos, sTopic):
+        dPatchRefs = self.getPatchRefs(dRepos, "topic:%s" % sTopic)
+        if not dPatchRefs:
+            raise FatalError("Topic %s was not found in any project." % sTopic)
+        dRepos = {sRepoUrl: sDirPath for sRepoUrl, sDirPath in dRepos.items() if sRepoUrl in dPatchRefs}
 
         def download(sRepoUrl):
-            nonlocal bFound
-            sPatchRef = self.getPatchRef(sRepoUrl, self.oArgs.change)
-            if sPatchRef:
-                print("Downloading change %s from %s" % (self.oArgs.change, sRepoUrl))
-                gerrit.download(sPatchRef, bDetach=self.oArgs.detach)
-                bFound = True
+            lPatchRefs = dPatchRefs[sRepoUrl]
+            print("Downloading %s %s from %s" % ("changes" if len(lPatchRefs) > 1 else "change",
+                                                 ", ".join(getPatchName(s) for s in lPatchRefs), sRepoUrl))
+            gerrit.download(lPatchRefs, bDetach=self.oArgs.detach)
+
+        lErrorRepos = self.runInRepos(dRepos, download)
+        print()
+        lRows = [["Repo", "Changes", "Result"]]
+        for sRepoUrl, sDirPath in dRepos.items():
+            if sDirPath in lErrorRepos:
+                sResult = "failed"
             else:
-                sErrMsg = "Change %s not found within this project" % self.oArgs.change
-                if self.oArgs.project:
-                    raise FatalError(sErrMsg)
-                else:
-                    print("Skipped: %s" % sErrMsg)
-
-        dFilteredRepos = {
-            sRepoUrl: sDirPath
-            for sRepoUrl, sDirPath in dRepos.items()
-            if not self.oArgs.project or self.oArgs.project == urlparse(sRepoUrl, allow_fragments=True).path[1:]
-        }
-        if not dFilteredRepos:
-            raise FatalError("No project \"%s\" found." % self.oArgs.project)
-
-        lErrorRepos = self.runInRepos(dFilteredRepos, download)
-        if not lErrorRepos and not bFound:
-            raise FatalError("Change %s was not found in any project." % self.oArgs.change)
+                sResult = "detached" if self.oArgs.detach else "rebased"
+            lRows.append([os.path.basename(sDirPath), ", ".join(getPatchName(s) for s in dPatchRefs[sRepoUrl]),
+                          sResult])
+        printTable(lRows)
         return lErrorRepos
 
-    def getPatchRef(self, sRepoUrl, sId):
-        if "/" in sId:
-            sId, sNumber = sId.split("/", maxsplit=1)
-            sRequest = "ALL_REVISIONS"
-        else:
-            sNumber = None
-            sRequest = "CURRENT_REVISION"
-        oApiClient = self.getApiClient()
-        for dChangeData in oApiClient.get("changes/?q=change:%s&o=%s" % (sId, sRequest)):
+    def getPatchRefs(self, dRepos, sQuery, sNumber=None):
+        """Resolves the patch refs of the changes matching a Gerrit query (e.g. "change:<id>" or "topic:<name>") with
+        a single request, and returns a dictionary with the URLs of the repos containing them as keys and the lists of
+        their refs as values. If sNumber is given, the refs of this patch set are returned instead of the current ones.
+
+        Each change is matched to the repos by fetch URL, or by project name if none of its fetch URLs is known."""
+        dRepoUrlsByProject = {}
+        for sRepoUrl in dRepos:
+            oEntry = self.getManifest().getByUrl(sRepoUrl)
+            if oEntry is not None:
+                dRepoUrlsByProject.setdefault(oEntry.sProject, []).append(sRepoUrl)
+
+        sRequest = "ALL_REVISIONS" if sNumber is not None else "CURRENT_REVISION"
+        dPatchRefs = OrderedDict((sRepoUrl, []) for sRepoUrl in dRepos)
+        for dChangeData in self.getApiClient().get("changes/?q=%s&o=%s" % (quote_plus(sQuery), sRequest)) or []:
             for dRevisionData in dChangeData["revisions"].values():
                 if sNumber is None or str(dRevisionData["_number"]) == sNumber:
-                    for dFetchData in dRevisionData["fetch"].values():
-                        if sRepoUrl == dFetchData["url"]:
-                            return dFetchData["ref"]
+                    lRepoUrls = [dFetchData["url"] for dFetchData in dRevisionData["fetch"].values()
+                                 if dFetchData["url"] in dPatchRefs]
+                    for sRepoUrl in lRepoUrls or dRepoUrlsByProject.get(dChangeData["project"], []):
+                        dPatchRefs[sRepoUrl].append(dRevisionData["ref"])
+        return OrderedDict((sRepoUrl, lRefs) for sRepoUrl, lRefs in dPatchRefs.items() if lRefs)
 
     def REBASE(self):
         print("Rebasing current state on %s" % self.oArgs.topic)
@@ -378,23 +837,36 @@ class RepoLite:
         sCurrentBranch = git.getCurrentBranch()
         if sCurrentBranch:
             print("Renaming topic: %s -> %s" % (sCurrentBranch, self.oArgs.topic))
-            subprocess.run(["git", "branch", "-m", self.oArgs.topic], check=True)
+            run(["git", "branch", "-m", self.oArgs.topic], check=True)
         else:
             raise FatalError("There is no topic")
 
     def STASH(self):
         print("Stashing content")
-        subprocess.run(["git", "stash"], check=True)
+        run(["git", "stash"], check=True)
 
     def POP(self):
         print("Retrieving stashed content")
-        sOutput = subprocess.run(["git", "stash", "list"], check=True, capture_output=True, encoding="utf-8").stdout
+        sOutput = run(["git", "stash", "list"], check=True, capture_output=True, encoding="utf-8").stdout
         if list(filter(bool, sOutput.splitlines())):
-            subprocess.run(["git", "stash", "pop"], check=True)
+            run(["git", "stash", "pop"], check=True)
         else:
             warning("No content to retrieve")
 
 
+def printTable(lRows):
+    """Prints the rows in aligned columns, the first one being the header"""
+    lWidths = [max(len(lRow[iIdx]) for lRow in lRows) for iIdx in range(len(lRows[0]))]
+    for iIdx, lRow in enumerate(lRows):
+        sLine = "  ".join(sCell.ljust(iWidth) for sCell, iWidth in zip(lRow, lWidths)).rstrip()
+        print(oTerminal.bold(sLine) if iIdx == 0 else sLine)
+
+
+def getPatchName(sPatchRef):
+    """Returns the change and patch set numbers of a patch ref, e.g. "1234/5" for refs/changes/34/1234/5"""
+    return "/".join(sPatchRef.split("/")[3:5])
+
+
 def main():
     oRepoLite = RepoLite(parseArgs())
     try:
@@ -413,49 +885,109 @@ def main():
         fatalError("Program interrupted.")
 
 
+def splitList(lValues):
+    """Splits the values of an option which can be repeated and contain comma-separated values"""
+    return [s.strip() for sValue in lValues for s in sValue.split(",") if s.strip()]
+
+
+def addCommonArguments(oParser, xDefault):
+    oParser.add_argument("-j", "--jobs", help="Number of repositories to process in parallel, see also the jobs setting"
+                                              " of the config file", type=int, default=xDefault)
+    oParser.add_argument("--only", help="Only processes these repositories (project names or directories, "
+                                        "comma-separated)", action="append", default=xDefault)
+    oParser.add_argument("--group", help="Only processes the repositories of these groups of the manifest "
+                                         "(comma-separated)", action="append", default=xDefault)
+    oParser.add_argument("--changed-since", help="Only processes the repositories with commits since this date, "
+                                                 "e.g. \"2 weeks ago\" or 2020-05-15", default=xDefault)
+
+
 def parseArgs():
     oParser = argparse.ArgumentParser(description="Lite version of repo")
     oParser.add_argument("-m", "--manifest", help="Manifest file", default="manifest.txt")
+    addCommonArguments(oParser, None)
     oSubparsers = oParser.add_subparsers(dest="command", required=True)
 
-    oSyncParser = oSubparsers.add_parser("sync", help="Sync and rebase")
-    oSyncParser.add_argument("-d", "--detach", help="Detaches HEAD instead of rebasing", action="store_true")
+    # Allows to specify the common options after the command as well, e.g. "repo sync -j 8"
+    oCommonParser = argparse.ArgumentParser(add_help=False)
+    addCommonArguments(oCommonParser, argparse.SUPPRESS)
+
+    def addParser(*args, **kwargs):
+        return oSubparsers.add_parser(*args, parents=[oCommonParser], **kwargs)
 
-    oStartParser = oSubparsers.add_parser("start", help="Start topic")
+    oSyncParser = addParser("sync", help="Sync and rebase")
+    oSyncParser.add_argument("-d", "--detach", help="Detaches HEAD instead of rebasing", action="store_true")
+    oSyncParser.add_argument("--depth", help="Clones missing repos with a history truncated to this number of commits",
+                             type=int)
+    oSyncParser.add_argument("--filter", help="Clones missing repos partially, e.g. blob:none or tree:0")
+    oSyncParser.add_argument("--single-branch", help="Clones only the default branch of missing repos",
+                             action="store_true")
+    oSyncParser.add_argument("--full", help="Fetches all repos, even the ones whose remote did not change",
+                             action="store_true")
+    oSyncParser.add_argument("--mirror", help="Folder of the local mirrors used to share the objects between clones")
+
+    oStartParser = addParser("start", help="Start topic")
     oStartParser.add_argument("topic", help="Topic name")
 
-    oSwitchParser = oSubparsers.add_parser("switch", help="Switch topic")
+    oSwitchParser = addParser("switch", help="Switch topic")
     oSwitchParser.add_argument("topic", help="Topic name")
 
-    oEndParser = oSubparsers.add_parser("end", help="End and delete topic")
+    oEndParser = addParser("end", help="End and delete topic")
     oEndParser.add_argument("topic", help="Topic name")
 
-    oForAllParser = oSubparsers.add_parser("forall", help="Execute a command on all repos")
+    oForAllParser = addParser("forall", help="Execute a command on all repos")
     oForAllParser.add_argument("command_line", help="Command to execute")
+    oForAllParser.add_argument("--group-output", help="Prints the output of each repo in one block once its command "
+                                                      "is complete, instead of prefixed lines as soon as available",
+                               action="store_true")
+    oForAllParser.add_argument("--timeout", help="Number of seconds after which the command is stopped in a repo",
+                               type=float)
+    oForAllParser.add_argument("--fail-fast", help="Stops all repos as soon as the command fails in one",
+                               action="store_true")
+
+    addParser("topic", help="Show current topics")
 
-    oSubparsers.add_parser("topic", help="Show current topics")
+    addParser("status", help="Show the state of all repos")
 
-    oSubparsers.add_parser("push", help="Push all repos")
+    addParser("push", help="Push all repos")
 
-    oSubparsers.add_parser("pull", help="Pull all repos")
+    addParser("pull", help="Pull all repos")
 
-    oDownloadParser = oSubparsers.add_parser("download", help="Download a patch and rebase on it")
+    oDownloadParser = addParser("download", help="Download a patch and rebase on it")
     oDownloadParser.add_argument("project", help="Project name", nargs="?")
-    oDownloadParser.add_argument("change", help="Change or patch ID, possibly with version specifier")
+    oDownloadParser.add_argument("change", help="Change or patch ID, possibly with version specifier", nargs="?")
     oDownloadParser.add_argument("-d", "--detach", help="Detaches HEAD instead of rebasing", action="store_true")
+    oDownloadParser.add_argument("-t", "--topic", help="Downloads all the changes of this Gerrit topic instead")
 
-    oRebaseParser = oSubparsers.add_parser("rebase", help="Rebase the current topic on another (local) one")
+    oRebaseParser = addParser("rebase", help="Rebase the current topic on another (local) one")
     oRebaseParser.add_argument("topic", help="Topic to rebase onto")
 
-    oRenameParser = oSubparsers.add_parser("rename", help="Rename the current topic")
+    oRenameParser = addParser("rename", help="Rename the current topic")
     oRenameParser.add_argument("topic", help="New topic name")
 
-    oSubparsers.add_parser("stash", help="Stashes changes of all repos")
+    addParser("stash", help="Stashes changes of all repos")
 
-    oSubparsers.add_parser("pop", help="Pops stash list of all repos")
+    addParser("pop", help="Pops stash list of all repos")
 
     oArgs = oParser.parse_args()
     oArgs.manifest = os.path.abspath(oArgs.manifest)
+    if oArgs.jobs is None:
+        try:
+            oArgs.jobs = config.getSettings(os.getcwd()).getInt("jobs", 1)
+        except FatalError as e:
+            oParser.error(str(e))
+    if oArgs.jobs < 1:
+        oParser.error("the number of jobs must be at least 1")
+    if getattr(oArgs, "depth", None) is not None and oArgs.depth < 1:
+        oParser.error("the depth must be at least 1")
+    if oArgs.command == "download":
+        if oArgs.topic is not None:
+            if oArgs.project is not None:
+                oParser.error("no change can be given together with a topic")
+        elif oArgs.change is None:
+            # With a single positional argument, it is the change and not the project
+            if oArgs.project is None:
+                oParser.error("the following arguments are required: change")
+            oArgs.project, oArgs.change = None, oArgs.project
     return oArgs
 
 
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2020 Quoc-Nam Dessoulles
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+"""Manifest of the repositories, compiled into an index cached on disk"""
+
+__author__ = "Quoc-Nam Dessoulles"
+__email__ = "cokie.forever@gmail.com"
+__license__ = "MIT"
+
+import hashlib
+import json
+import os
+import tempfile
+from collections import OrderedDict
+from urllib.parse import urlparse, unquote
+
+from repolite.util.misc import FatalError, hideFile
+
+CACHE_VERSION = 3
+
+
+class ManifestEntry:
+    def __init__(self, sRepoUrl, sDirPath, lCloneOptions, lGroups):
+        oUrl = urlparse(sRepoUrl, allow_fragments=True)
+        self.sRepoUrl = sRepoUrl
+        self.sDirPath = sDirPath
+        self.sProject = unquote(oUrl.path[1:])
+        self.sHost = oUrl.hostname or ""
+        self.lCloneOptions = lCloneOptions
+        self.lGroups = lGroups
+
+    def toList(self):
+        return [self.sRepoUrl, self.sDirPath, self.lCloneOptions, self.lGroups]
+
+
+class Manifest:
+    """List of the repositories of the manifest, in order, indexed by URL, project and directory"""
+
+    def __init__(self, lEntries):
+        self.lEntries = lEntries
+        self.dByUrl = OrderedDict((oEntry.sRepoUrl, oEntry) for oEntry in lEntries)
+        self.dByProject = OrderedDict()
+        for oEntry in lEntries:
+            self.dByProject.setdefault(oEntry.sProject, []).append(oEntry)
+        self.dByDir = {os.path.normcase(oEntry.sDirPath): oEntry for oEntry in lEntries}
+        self.dByGroup = {}
+        for oEntry in lEntries:
+            for sGroup in oEntry.lGroups:
+                self.dByGroup.setdefault(sGroup, []).append(oEntry)
+
+    def getByUrl(self, sRepoUrl):
+        return self.dByUrl.get(sRepoUrl)
+
+    def getByProject(self, sProject):
+        return self.dByProject.get(sProject, [])
+
+    def getByGroup(self, sGroup):
+        return self.dByGroup.get(sGroup, [])
+
+    def getByDir(self, sDirPath):
+        return self.dByDir.get(os.path.normcase(os.path.abspath(sDirPath)))
+
+    def getExistingDirs(self):
+        """Returns the directories of the manifest which exist, with one listing per parent folder instead of one
+        check per directory"""
+        setExisting = set()
+        dByParent = {}
+        for oEntry in self.lEntries:
+            dByParent.setdefault(os.path.dirname(oEntry.sDirPath), []).append(oEntry.sDirPath)
+        for sParent, lDirPaths in dByParent.items():
+            try:
+                with os.scandir(sParent) as oIterator:
+                    setNames = {os.path.normcase(o.name) for o in oIterator if o.is_dir()}
+            except OSError:
+                continue
+            setExisting.update(s for s in lDirPaths if os.path.normcase(os.path.basename(s)) in setNames)
+        return setExisting
+
+    @staticmethod
+    def parse(sFile, sRootFolder, lSources=None):
+        """Parses a manifest file and the files it includes, whose paths are appended to lSources if given"""
+        lEntries = []
+        lStack = []
+
+        def parseFile(sPath):
+            sPath = os.path.normcase(os.path.abspath(sPath))
+            if sPath in lStack:
+                raise FatalError("The manifest file %s includes itself." % sPath)
+            lStack.append(sPath)
+            if lSources is not None:
+                lSources.append(sPath)
+            with open(sPath) as oFile:
+                for sLine in oFile:
+                    sLine = sLine.strip()
+                    if not sLine or sLine.startswith("#"):
+                        continue
+                    lElements = sLine.split(" ")
+                    if lElements[0] == "include":
+                        # Relative to the including file
+                        parseFile(os.path.join(os.path.dirname(sPath), " ".join(lElements[1:])))
+                        continue
+                    # Options, e.g. --depth=1 or --groups=a,b, may follow the URL and the directory
+                    iOptionsStart = len(lElements)
+                    while iOptionsStart > 1 and lElements[iOptionsStart - 1].startswith("--"):
+                        iOptionsStart -= 1
+                    (sRepoUrl, sDirPath) = lElements[0], " ".join(lElements[1:iOptionsStart])
+                    lGroups = []
+                    lCloneOptions = []
+                    for sOption in lElements[iOptionsStart:]:
+                        if sOption.startswith("--groups="):
+                            lGroups += [s for s in sOption[len("--groups="):].split(",") if s]
+                        else:
+                            lCloneOptions.append(sOption)
+                    lCloneOptions = list(parseCloneOptions(lCloneOptions).values())
+                    if not sDirPath:
+                        sDirPath = unquote(urlparse(sRepoUrl, allow_fragments=True).path.split("/")[-1])
+                    sDirPath = os.path.normpath(os.path.join(sRootFolder, sDirPath))
+                    lEntries.append(ManifestEntry(sRepoUrl, sDirPath, lCloneOptions, lGroups))
+            lStack.pop()
+
+        parseFile(sFile)
+        return Manifest(lEntries)
+
+    @staticmethod
+    def load(sFile, sRootFolder, sCacheFile):
+        """Returns the manifest, from the cache if none of the manifest files changed since it was compiled"""
+        if not os.path.isfile(sFile):
+            raise FatalError("The manifest file %s does not exist." % sFile)
+        try:
+            dCache = readCache(sCacheFile)
+            lKey = [CACHE_VERSION, os.path.normcase(sFile), os.path.normcase(sRootFolder)]
+            if dCache is not None and dCache.get("key") == lKey:
+                try:
+                    lStats = getStats(dCache["sources"])
+                    if lStats == dCache["stats"]:
+                        return Manifest([ManifestEntry(*lEntry) for lEntry in dCache["manifest"]])
+                    # Touched but maybe not modified, e.g. after a checkout
+                    if hashFiles(dCache["sources"]) == dCache["hash"]:
+                        dCache["stats"] = lStats
+                        writeCache(sCacheFile, dCache)
+                        return Manifest([ManifestEntry(*lEntry) for lEntry in dCache["manifest"]])
+                except OSError:
+                    # An included file was removed
+                    pass
+                except (KeyError, TypeError, ValueError):
+                    # Not written by this version
+                    pass
+            lSources = []
+            oManifest = Manifest.parse(sFile, sRootFolder, lSources)
+            writeCache(sCacheFile, {"key": lKey, "sources": lSources, "stats": getStats(lSources),
+                                    "hash": hashFiles(lSources),
+                                    "manifest": [oEntry.toList() for oEntry in oManifest.lEntries]})
+            return oManifest
+        except OSError as e:
+            raise FatalError(e)
+
+
+def parseCloneOptions(lOptions):
+    """Validates options of git clone, returns them by name"""
+    dOptions = OrderedDict()
+    for sOption in lOptions:
+        sName, _, sValue = sOption.partition("=")
+        if (sName == "--depth" and sValue.isdigit() and int(sValue) > 0) or (sName == "--filter" and sValue):
+            dOptions[sName] = sOption
+        elif sName in ("--single-branch", "--no-single-branch") and not sValue:
+            dOptions["--single-branch"] = sOption
+        else:
+            raise FatalError("Invalid clone option: %s" % sOption)
+    return dOptions
+
+
+def getStats(lFiles):
+    # Lists rather than tuples, to be compared with the ones read from the JSON cache
+    return [[oStat.st_mtime_ns, oStat.st_size] for oStat in map(os.stat, lFiles)]
+
+
+def hashFiles(lFiles):
+    oHash = hashlib.sha256()
+    for sFile in lFiles:
+        with open(sFile, "rb") as oFile:
+            oHash.update(hashlib.sha256(oFile.read()).digest())
+    return oHash.hexdigest()
+
+
+def readCache(sCacheFile):
+    try:
+        with open(sCacheFile, "r", encoding="utf-8") as oFile:
+            dCache = json.load(oFile)
+        return dCache if isinstance(dCache, dict) else None
+    except (OSError, ValueError):
+        # Missing or corrupted, it will simply be rebuilt
+        return None
+
+
+def writeCache(sCacheFile, dCache):
+    sFolder = os.path.dirname(sCacheFile)
+    try:
+        os.makedirs(sFolder, exist_ok=True)
+        hideFile(sFolder)
+        iFd, sTempFile = tempfile.mkstemp(dir=sFolder)
+    except OSError:
+        # The cache is only an optimization
+        return
+    try:
+        with os.fdopen(iFd, "w", encoding="utf-8") as oFile:
+            json.dump(dCache, oFile)
+        os.replace(sTempFile, sCacheFile)
+    except OSError:
+        try:
+            os.remove(sTempFile)
+        except OSError:
+            pass
@@ -27,6 +27,9 @@ __author__ = "Quoc-Nam Dessoulles"
 __email__ = "cokie.forever@gmail.com"
 __license__ = "MIT"
 
+import http.server
+import os
+import threading
 from urllib.parse import quote
 
 from repolite.tests.util.test_base import TestBase
@@ -50,3 +53,72 @@ class TestApi(TestBase):
                 assert dChange["branch"] == "master"
                 assert dChange["change_id"] == sChangeId
                 assert dChange["status"] == "NEW"
+
+
+class TestResponseCache:
+    def test_get_ttl(self, tmp_path):
+        oCache = gerrit.ResponseCache(str(tmp_path), iTtl=60)
+        oCache.put("key", None, "content")
+
+        dEntry = oCache.get("key")
+        assert dEntry["content"] == "content"
+        assert oCache.isFresh(dEntry)
+        dEntry["time"] -= 61
+        assert not oCache.isFresh(dEntry)
+        assert oCache.get("other key") is None
+
+    def test_evict(self, tmp_path):
+        oCache = gerrit.ResponseCache(str(tmp_path))
+        lEvictions = []
+        xEvict = oCache.evict
+        oCache.evict = lambda: lEvictions.append(None) or xEvict()
+        for iIdx in range(6):
+            oCache.put("key %d" % iIdx, None, "x" * 100)
+            # Makes the order of the entries independent of the resolution of the file times
+            os.utime(oCache.getFile("key %d" % iIdx), (iIdx, iIdx))
+            if iIdx == 0:
+                # Room for 5 entries only
+                oCache.iMaxSize = oCache.iSize * 5.5
+
+        # One scan to initialize the size, and one when it goes over the limit
+        assert len(lEvictions) == 2
+        assert oCache.iSize <= oCache.iMaxSize * oCache.EVICTION_RATIO
+        assert oCache.iSize == sum(oEntry.stat().st_size for oEntry in os.scandir(str(tmp_path)))
+        assert [oCache.get("key %d" % iIdx) is not None for iIdx in range(6)] == [False, False] + [True] * 4
+
+    def test_cachedGet_etag(self, tmp_path):
+        lRequests = []
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                lRequests.append(self.headers.get("If-None-Match"))
+                if self.headers.get("If-None-Match") == '"v1"':
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                bContent = b")]}'\n" + b'{"value": 1}'
+                self.send_response(200)
+                self.send_header("ETag", '"v1"')
+                self.send_header("Content-Length", str(len(bContent)))
+                self.end_headers()
+                self.wfile.write(bContent)
+
+            def log_message(self, *args):
+                pass
+
+        oServer = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=oServer.serve_forever, daemon=True).start()
+        try:
+            sUrl = "http://127.0.0.1:%d" % oServer.server_address[1]
+            oApiClient = gerrit.ApiClient(sUrl, "user", "password", oCache=gerrit.ResponseCache(str(tmp_path)))
+            assert oApiClient.get("changes/1") == {"value": 1}
+            assert oApiClient.get("changes/1") == {"value": 1}
+            assert lRequests == [None, '"v1"']
+
+            # Within the TTL, Gerrit is not contacted at all
+            oApiClient.oCache.iTtl = 60
+            assert oApiClient.get("changes/1") == {"value": 1}
+            assert len(lRequests) == 2
+        finally:
+            oServer.shutdown()
+            oServer.server_close()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2020 Quoc-Nam Dessoulles
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+"""Tests of the git utilities, on local repositories only"""
+
+__author__ = "Quoc-Nam Dessoulles"
+__email__ = "cokie.forever@gmail.com"
+__license__ = "MIT"
+
+import os
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from repolite.tests.util.test_setup import configureGit
+from repolite.util.misc import workingDir
+from repolite.vcs import git, gerrit
+
+
+class TestGit:
+    @pytest.fixture(autouse=True)
+    def setupRepo(self, tmp_path):
+        self.sRepoFolder = str(tmp_path / "repo")
+        os.makedirs(self.sRepoFolder)
+        self.runGit(["init", "-q"])
+        configureGit(self.sRepoFolder)
+        self.createCommit("base.txt", "Initial commit")
+        with workingDir(self.sRepoFolder), git.catFilePool():
+            yield
+
+    def runGit(self, lArgs, **kwargs):
+        return subprocess.run(["git"] + lArgs, cwd=self.sRepoFolder, check=True, capture_output=True,
+                              encoding="utf-8", **kwargs)
+
+    def createCommit(self, sFileName, sMessage, sContent=None, sAuthor=None):
+        with open(os.path.join(self.sRepoFolder, sFileName), "w") as oFile:
+            oFile.write(sContent if sContent is not None else sMessage)
+        self.runGit(["add", sFileName])
+        self.runGit(["commit", "-q", "-m", sMessage] + (["--author", sAuthor] if sAuthor else []))
+
+    def getLog(self, sFormat):
+        return self.runGit(["log", "--format=%s%%x00" % sFormat]).stdout.split("\0\n")[:-1]
+
+    def createTopic(self, lCommits):
+        """Creates a target branch with one commit, and a topic branch with the given (file, message) commits"""
+        self.runGit(["branch", "topic"])
+        self.createCommit("conflict.txt", "Target commit", sContent="target")
+        self.runGit(["branch", "-m", "target"])
+        self.runGit(["checkout", "-q", "topic"])
+        for iIdx, (sFileName, sContent) in enumerate(lCommits):
+            self.createCommit(sFileName, "Topic commit %d\n\nChange-Id: I%040x" % (iIdx, iIdx), sContent=sContent,
+                              sAuthor="Topic Author <topic@example.com>")
+
+    @pytest.mark.skipif(not git.canPickInMemory(), reason="Requires Git 2.40 or later")
+    def test_rebase_inMemory(self, monkeypatch):
+        self.createTopic([("topic_0.txt", "topic 0"), ("topic_1.txt", "topic 1")])
+        sWorktreeFile = os.path.join(self.sRepoFolder, "topic_1.txt")
+        lOriginalMessages = self.getLog("%B")[:2]
+        monkeypatch.setattr(git, "cherryPick", lambda *args, **kwargs: pytest.fail("Unexpected cherry-pick"))
+
+        gerrit.rebase("target")
+
+        assert git.getCurrentBranch() == "topic"
+        assert self.getLog("%s") == ["Topic commit 1", "Topic commit 0", "Target commit", "Initial commit"]
+        assert self.getLog("%B")[:2] == lOriginalMessages
+        assert self.getLog("%an <%ae>")[:2] == ["Topic Author <topic@example.com>"] * 2
+        assert os.path.isfile(sWorktreeFile)
+        assert self.runGit(["status", "--porcelain"]).stdout == ""
+
+    def test_rebase_conflict(self, monkeypatch):
+        self.createTopic([("topic_0.txt", "topic 0"), ("conflict.txt", "topic"), ("topic_2.txt", "topic 2")])
+        lPrompts = []
+
+        def resolveConflict(sMessage):
+            lPrompts.append(sMessage)
+            with open(os.path.join(self.sRepoFolder, "conflict.txt"), "w") as oFile:
+                oFile.write("resolved")
+            self.runGit(["add", "conflict.txt"])
+            return ""
+
+        monkeypatch.setattr(git, "prompt", resolveConflict)
+
+        gerrit.rebase("target")
+
+        assert len(lPrompts) == 1
+        assert git.getCurrentBranch() == "topic"
+        assert self.getLog("%s") == ["Topic commit 2", "Topic commit 1", "Topic commit 0", "Target commit",
+                                     "Initial commit"]
+        assert self.getLog("%an <%ae>")[:3] == ["Topic Author <topic@example.com>"] * 3
+        with open(os.path.join(self.sRepoFolder, "conflict.txt")) as oFile:
+            assert oFile.read() == "resolved"
+        assert os.path.isfile(os.path.join(self.sRepoFolder, "topic_2.txt"))
+
+    def test_readCurrentBranch(self):
+        self.runGit(["checkout", "-q", "-b", "topic"])
+        assert git.readCurrentBranch(self.sRepoFolder) == "topic"
+
+        self.runGit(["checkout", "-q", "--detach"])
+        assert git.readCurrentBranch(self.sRepoFolder) == ""
+        assert git.getCurrentBranch() == ""
+
+    def test_readCurrentBranch_worktree(self):
+        sWorktreeFolder = os.path.join(os.path.dirname(self.sRepoFolder), "worktree")
+        self.runGit(["worktree", "add", "-q", "-b", "worktree_topic", sWorktreeFolder])
+        assert os.path.isfile(os.path.join(sWorktreeFolder, ".git"))
+        assert git.readCurrentBranch(sWorktreeFolder) == "worktree_topic"
+        assert git.getCurrentBranch(sCwd=sWorktreeFolder) == "worktree_topic"
+
+        subprocess.run(["git", "checkout", "-q", "--detach"], cwd=sWorktreeFolder, check=True)
+        assert git.readCurrentBranch(sWorktreeFolder) == ""
+
+    def test_readCurrentBranch_unsupported(self):
+        # Placeholder written in HEAD by the reftable format
+        sFolder = os.path.join(os.path.dirname(self.sRepoFolder), "reftable")
+        os.makedirs(os.path.join(sFolder, ".git"))
+        with open(os.path.join(sFolder, ".git", "HEAD"), "w") as oFile:
+            oFile.write("ref: refs/heads/.invalid\n")
+        assert git.readCurrentBranch(sFolder) is None
+
+        assert git.readCurrentBranch(os.path.dirname(self.sRepoFolder)) is None
+
+    def test_updateMirror_concurrent(self):
+        # Fresh bootstrap of the store of a host by parallel syncs
+        sParentFolder = os.path.dirname(self.sRepoFolder)
+        sMirrorFolder = os.path.join(sParentFolder, "mirror")
+        lRepoUrls = []
+        for iIdx in range(4):
+            sBareFolder = os.path.join(sParentFolder, "project_%d.git" % iIdx)
+            subprocess.run(["git", "clone", "-q", "--bare", self.sRepoFolder, sBareFolder], check=True)
+            lRepoUrls.append("file://" + sBareFolder.replace(os.sep, "/"))
+
+        with ThreadPoolExecutor(len(lRepoUrls)) as oExecutor:
+            lMirrorPaths = list(oExecutor.map(lambda sRepoUrl: git.updateMirror(sMirrorFolder, sRepoUrl), lRepoUrls))
+
+        assert len(set(lMirrorPaths)) == 1
+        lRefs = subprocess.run(["git", "for-each-ref", "--format=%(refname)"], cwd=lMirrorPaths[0], check=True,
+                               capture_output=True, encoding="utf-8").stdout.split()
+        assert len(lRefs) == len(lRepoUrls)
+
+    def test_download_severalPatches(self):
+        # Relation chain of two changes, plus an unrelated one, on a remote
+        sRemoteFolder = os.path.join(os.path.dirname(self.sRepoFolder), "remote.git")
+        subprocess.run(["git", "init", "-q", "--bare", sRemoteFolder], check=True)
+        self.runGit(["remote", "add", "origin", sRemoteFolder])
+        sBase = git.getLastCommit()
+        for iIdx, sParent in enumerate([sBase, "HEAD", sBase]):
+            self.runGit(["checkout", "-q", "--detach", sParent])
+            self.createCommit("change_%d.txt" % iIdx, "Change %d\n\nChange-Id: I%040x" % (iIdx, iIdx))
+            self.runGit(["push", "-q", "origin", "HEAD:refs/changes/%02d/%d/1" % (iIdx, iIdx)])
+        self.runGit(["checkout", "-q", "-B", "topic", sBase])
+        self.createCommit("local.txt", "Local commit\n\nChange-Id: I%040x" % 10)
+
+        gerrit.download(["refs/changes/%02d/%d/1" % (iIdx, iIdx) for iIdx in range(3)])
+
+        assert git.getCurrentBranch() == "topic"
+        assert sorted(self.getLog("%s")[:4]) == ["Change 0", "Change 1", "Change 2", "Local commit"]
+        assert self.getLog("%s")[0] == "Local commit"
+        # Parents first
+        assert self.getLog("%s").index("Change 1") < self.getLog("%s").index("Change 0")
+        for iIdx in range(3):
+            assert os.path.isfile(os.path.join(self.sRepoFolder, "change_%d.txt" % iIdx))
+        assert self.runGit(["for-each-ref", git.DOWNLOADED_REFS]).stdout == ""
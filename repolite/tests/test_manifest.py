@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2020 Quoc-Nam Dessoulles
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+"""Tests of the manifest and of its cache"""
+
+__author__ = "Quoc-Nam Dessoulles"
+__email__ = "cokie.forever@gmail.com"
+__license__ = "MIT"
+
+import os
+
+import pytest
+
+from repolite.manifest import Manifest
+
+
+class TestManifest:
+    @pytest.fixture(autouse=True)
+    def setupFiles(self, tmp_path):
+        self.sRootFolder = str(tmp_path)
+        self.sManifestFile = os.path.join(self.sRootFolder, "manifest.txt")
+        self.sIncludedFile = os.path.join(self.sRootFolder, "sub", "more.txt")
+        self.sCacheFile = os.path.join(self.sRootFolder, ".repolite", "manifest")
+        os.makedirs(os.path.dirname(self.sIncludedFile))
+        self.writeFile(self.sManifestFile, "# Main projects\nssh://host/a.git --groups=core\ninclude sub/more.txt\n")
+        self.writeFile(self.sIncludedFile, "ssh://host/b.git b_dir --depth=1\n")
+
+    @staticmethod
+    def writeFile(sFile, sContent):
+        with open(sFile, "w") as oFile:
+            oFile.write(sContent)
+
+    def load(self):
+        oManifest = Manifest.load(self.sManifestFile, self.sRootFolder, self.sCacheFile)
+        return [(oEntry.sRepoUrl, os.path.relpath(oEntry.sDirPath, self.sRootFolder), oEntry.lCloneOptions,
+                 oEntry.lGroups) for oEntry in oManifest.lEntries]
+
+    def forbidParsing(self, monkeypatch):
+        monkeypatch.setattr(Manifest, "parse", staticmethod(lambda *args: pytest.fail("Unexpected parsing")))
+
+    def test_load(self, monkeypatch):
+        lExpectedEntries = [("ssh://host/a.git", "a.git", [], ["core"]),
+                            ("ssh://host/b.git", "b_dir", ["--depth=1"], [])]
+        assert self.load() == lExpectedEntries
+        assert os.path.isfile(self.sCacheFile)
+
+        self.forbidParsing(monkeypatch)
+        assert self.load() == lExpectedEntries
+
+    def test_load_touched(self, monkeypatch):
+        self.load()
+        oStat = os.stat(self.sIncludedFile)
+        os.utime(self.sIncludedFile, ns=(oStat.st_atime_ns, oStat.st_mtime_ns + 10 ** 9))
+
+        # Same content, the cache is still used
+        self.forbidParsing(monkeypatch)
+        assert len(self.load()) == 2
+
+    def test_load_includedFileChanged(self):
+        self.load()
+        self.writeFile(self.sIncludedFile, "ssh://host/b.git b_dir --depth=1\nssh://host/c.git\n")
+
+        assert [tEntry[0] for tEntry in self.load()] == ["ssh://host/a.git", "ssh://host/b.git", "ssh://host/c.git"]
+
+    def test_load_includedFileRemoved(self):
+        self.load()
+        self.writeFile(self.sManifestFile, "ssh://host/a.git\n")
+        os.remove(self.sIncludedFile)
+
+        assert [tEntry[0] for tEntry in self.load()] == ["ssh://host/a.git"]
+
+    def test_load_corruptedCache(self):
+        self.load()
+        self.writeFile(self.sCacheFile, '{"key": [')
+
+        assert len(self.load()) == 2
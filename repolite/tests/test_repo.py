@@ -29,6 +29,9 @@ __license__ = "MIT"
 
 import os
 import re
+import shlex
+import sys
+import time
 from urllib.parse import quote_plus
 
 import pytest
@@ -112,6 +115,40 @@ class TestRepo(TestBase):
                 assert os.path.isfile("test_1.txt")
                 assert git.getGitMessages() == ["Test commit (2)", "Test commit (1)", INITIAL_COMMIT_MSG]
 
+    def test_repoSync_parallel(self):
+        self.runRepo(["start", "topic_2"])
+        self.runRepo(["start", "topic_1"])
+        self.createCommit(sId="1")
+        for iChangeNumber in self.push():
+            self.merge(iChangeNumber)
+        self.runRepo(["switch", "topic_2"])
+        self.createCommit(sId="2")
+
+        sOutput = self.runRepo(["sync", "-j", "3"]).stdout
+
+        lOutputLines = list(filter(bool, sOutput.splitlines()))
+        for sProjectFolder in self.dProjectFolders:
+            iIdx = lOutputLines.index("### %s ###" % os.path.basename(sProjectFolder))
+            assert lOutputLines[iIdx + 1].startswith("Syncing from ")
+        for sProjectFolder in self.dProjectFolders:
+            with changeWorkingDir(sProjectFolder):
+                assert git.getCurrentBranch() == "topic_2"
+                assert git.getGitMessages() == ["Test commit (2)", "Test commit (1)", INITIAL_COMMIT_MSG]
+
+    def test_repoSync_unchanged(self):
+        self.runRepo(["start", "topic"])
+        self.createCommit()
+
+        sOutput = self.runRepo(["sync"]).stdout
+
+        lOutputLines = list(filter(bool, sOutput.splitlines()))
+        for sProjectFolder in self.dProjectFolders:
+            iIdx = lOutputLines.index("### %s ###" % os.path.basename(sProjectFolder))
+            assert lOutputLines[iIdx + 1].startswith("Already up-to-date with ")
+            with changeWorkingDir(sProjectFolder):
+                assert git.getCurrentBranch() == "topic"
+                assert git.getGitMessages() == ["Test commit (1)", INITIAL_COMMIT_MSG]
+
     def test_repoEnd_whenActive(self):
         self.runRepo(["start", "topic"])
         self.createCommit()
@@ -169,6 +206,137 @@ class TestRepo(TestBase):
             assert len(dJson) == 1
             assert dJson[0]["project"] == sProjectName
 
+    def test_repoStatus(self):
+        self.runRepo(["start", "topic"])
+        self.createCommit()
+        self.push()
+        with open(os.path.join(next(iter(self.dProjectFolders)), "untracked.txt"), "w") as oFile:
+            oFile.write("This is an untracked file.")
+
+        sOutput = self.runRepo(["status"]).stdout
+
+        dRows = {lCells[0]: lCells for lCells in (s.split() for s in sOutput.splitlines()) if lCells}
+        for iIdx, sProjectFolder in enumerate(self.dProjectFolders):
+            lCells = dRows[os.path.basename(sProjectFolder)]
+            assert lCells[1:] == ["topic", "0", "1" if iIdx == 0 else "0", "+1/-0", "pushed"]
+
+    def rewriteManifest(self, xRewriteLine):
+        """Replaces each line of the manifest with xRewriteLine(index, line), which returns (manifest line, included
+        file line or None)"""
+        sManifestFile = os.path.join(self.sRepoFolder, "manifest.txt")
+        with open(sManifestFile) as oFile:
+            lLines = [xRewriteLine(iIdx, sLine.strip()) for iIdx, sLine in enumerate(oFile) if sLine.strip()]
+        with open(sManifestFile, "w") as oFile:
+            oFile.write("# Test manifest\n")
+            oFile.write("".join("%s\n" % sLine for sLine, _ in lLines if sLine))
+            if any(sIncludedLine for _, sIncludedLine in lLines):
+                oFile.write("include sub/included.txt\n")
+        os.makedirs(os.path.join(self.sRepoFolder, "sub"), exist_ok=True)
+        with open(os.path.join(self.sRepoFolder, "sub", "included.txt"), "w") as oFile:
+            oFile.write("".join("%s\n" % sLine for _, sLine in lLines if sLine))
+
+    def test_repoManifest_include(self):
+        # All projects but the first one come from the included file
+        self.rewriteManifest(lambda iIdx, sLine: (sLine, None) if iIdx == 0 else (None, sLine))
+
+        self.runRepo(["start", "topic"])
+
+        for sProjectFolder in self.dProjectFolders:
+            with changeWorkingDir(sProjectFolder):
+                assert git.getCurrentBranch() == "topic"
+
+    def test_repoGroup(self):
+        self.rewriteManifest(lambda iIdx, sLine: ("%s --groups=%s" % (sLine, "first" if iIdx == 0 else "others,all"),
+                                                  None))
+
+        self.runRepo(["start", "topic", "--group", "first"])
+
+        for iIdx, sProjectFolder in enumerate(self.dProjectFolders):
+            with changeWorkingDir(sProjectFolder):
+                assert git.getCurrentBranch() == ("topic" if iIdx == 0 else "")
+
+        oProcess = self.runRepo(["start", "topic", "--group", "foobar"], check=False)
+        assert oProcess.returncode != 0
+        assert "Unknown group: foobar" in oProcess.stdout
+
+    def test_repoOnly(self):
+        sProjectName = next(iter(self.dProjectFolders.values()))
+
+        self.runRepo(["start", "topic", "--only", sProjectName])
+
+        for iIdx, sProjectFolder in enumerate(self.dProjectFolders):
+            with changeWorkingDir(sProjectFolder):
+                assert git.getCurrentBranch() == ("topic" if iIdx == 0 else "")
+
+    def test_repoOnly_unknown(self):
+        oProcess = self.runRepo(["start", "topic", "--only", "foobar"], check=False)
+
+        assert oProcess.returncode != 0
+        assert "Unknown repository: foobar" in oProcess.stdout
+        for sProjectFolder in self.dProjectFolders:
+            with changeWorkingDir(sProjectFolder):
+                assert git.getCurrentBranch() == ""
+
+    @staticmethod
+    def getPythonCommand(sCode):
+        return " ".join(shlex.quote(s) for s in [sys.executable, "-c", sCode])
+
+    def test_repoForall_prefixedOutput(self):
+        sCommand = self.getPythonCommand("import os; print('Hello from', os.environ['REPO_PROJECT'])")
+
+        sOutput = self.runRepo(["forall", "-j", "2", sCommand]).stdout
+
+        lOutputLines = sOutput.splitlines()
+        for sProjectFolder, sProjectName in self.dProjectFolders.items():
+            assert "[%s] Hello from %s" % (os.path.basename(sProjectFolder), sProjectName) in lOutputLines
+
+    def test_repoForall_longLine(self):
+        sCommand = self.getPythonCommand("print('x' * 2000000); print('End')")
+
+        sOutput = self.runRepo(["forall", "-j", "2", "--fail-fast", sCommand]).stdout
+
+        lOutputLines = sOutput.splitlines()
+        for sProjectFolder in self.dProjectFolders:
+            sPrefix = "[%s] " % os.path.basename(sProjectFolder)
+            assert sum(len(s) - len(sPrefix) for s in lOutputLines if s.startswith(sPrefix + "x")) == 2000000
+            assert sPrefix + "End" in lOutputLines
+
+    def test_repoForall_failFast(self):
+        sFirstPath = os.path.relpath(next(iter(self.dProjectFolders)), self.sRepoFolder)
+        sCommand = self.getPythonCommand("import os, sys; print('Started'); sys.exit(os.environ['REPO_PATH'] == %r)"
+                                         % sFirstPath)
+
+        oProcess = self.runRepo(["forall", "-j", "1", "--fail-fast", sCommand], check=False)
+
+        assert oProcess.returncode != 0
+        assert oProcess.stdout.splitlines().count("Started") == 1
+        assert "Stopping after the first failure." in oProcess.stdout
+
+    def test_repoForall_timeout(self):
+        sCommand = self.getPythonCommand("import time; time.sleep(60)")
+
+        fStartTime = time.monotonic()
+        oProcess = self.runRepo(["forall", "-j", "2", "--timeout", "1", sCommand], check=False)
+
+        assert time.monotonic() - fStartTime < 30
+        assert oProcess.returncode != 0
+        for sProjectFolder in self.dProjectFolders:
+            assert "[%s] Timed out after 1 seconds" % os.path.basename(sProjectFolder) in oProcess.stdout
+
+    def test_repoForall_timeoutKillsChildren(self):
+        # With a single job the command uses the terminal, its children must be stopped as well
+        sCommand = self.getPythonCommand("import subprocess, sys, time; subprocess.Popen([sys.executable, '-c', "
+                                         "'import time; time.sleep(3); open(\"leftover.txt\", \"w\")']); "
+                                         "time.sleep(60)")
+
+        oProcess = self.runRepo(["forall", "-j", "1", "--timeout", "1", sCommand], check=False)
+
+        assert oProcess.returncode != 0
+        time.sleep(4)
+        for sProjectFolder in self.dProjectFolders:
+            assert "[%s] Timed out after 1 seconds" % os.path.basename(sProjectFolder) in oProcess.stdout
+            assert not os.path.exists(os.path.join(sProjectFolder, "leftover.txt"))
+
     def test_repoPush_updateChange(self):
         self.test_repoPush_newChange()
         self.createCommit(bAmend=True)
@@ -210,8 +378,8 @@ class TestRepo(TestBase):
 
         lOutputLines = list(filter(bool, oProcess.stdout.splitlines()))
         sName = os.path.basename(next(iter(self.dProjectFolders)))
-        lExpectedOutputLines = ["### %s ###" % sName, "WARN: You are about to overwrite unknown changes.",
-                                "Continue? (y/n): ERROR: [%s] Operation aborted" % sName]
+        lExpectedOutputLines = ["WARN: You are about to overwrite unknown changes in %s." % sName,
+                                "Continue? (y/n): ", "### %s ###" % sName, "ERROR: [%s] Operation aborted" % sName]
         assert lOutputLines[:len(lExpectedOutputLines)] == lExpectedOutputLines
 
         for iIdx, (sProjectFolder, sProjectName) in enumerate(self.dProjectFolders.items()):
@@ -427,6 +595,24 @@ class TestRepo(TestBase):
                     assert os.path.isfile("test_2.txt")
                     assert git.getGitMessages() == ["Test commit (2)", INITIAL_COMMIT_MSG]
 
+    def test_repoDownload_topic(self):
+        self.runRepo(["start", "topic_2"])
+        self.runRepo(["start", "topic_1"])
+        self.createCommit(sId="1")
+        for iChangeNumber in self.push():
+            self.oApiClient.put("changes/%d/topic" % iChangeNumber, json={"topic": "gerrit_topic"})
+        self.runRepo(["switch", "topic_2"])
+        self.createCommit(sId="2")
+
+        self.runRepo(["download", "--topic", "gerrit_topic"])
+
+        for sProjectFolder in self.dProjectFolders:
+            with changeWorkingDir(sProjectFolder):
+                assert git.getCurrentBranch() == "topic_2"
+                assert os.path.isfile("test_1.txt")
+                assert os.path.isfile("test_2.txt")
+                assert git.getGitMessages() == ["Test commit (2)", "Test commit (1)", INITIAL_COMMIT_MSG]
+
     def test_repoRebase_simple(self):
         self.runRepo(["start", "topic_2"])
         self.runRepo(["start", "topic_1"])
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2020 Quoc-Nam Dessoulles
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+"""Tests of the data stored by the repo tool"""
+
+__author__ = "Quoc-Nam Dessoulles"
+__email__ = "cokie.forever@gmail.com"
+__license__ = "MIT"
+
+import argparse
+import json
+import os
+
+from repolite.main_repo import RepoLite, RepoData
+
+
+class TestRepoData:
+    def test_setAndGet(self, tmp_path):
+        oRepoData = RepoData(str(tmp_path / "data.sqlite"))
+        oRepoData.setLastPushedCommits({("project_1", "I1"): "a" * 40, ("project_2", "I2"): "b" * 40})
+        oRepoData.setLastPushedCommit("project_1", "I1", "c" * 40)
+        oRepoData.setLastSyncedCommits({"project_1": "d" * 40})
+
+        assert oRepoData.getLastPushedCommit("project_1", "I1") == "c" * 40
+        assert oRepoData.getLastPushedCommit("project_1", "I2") is None
+        assert oRepoData.getAllLastPushedCommits() == {("project_1", "I1"): "c" * 40, ("project_2", "I2"): "b" * 40}
+        assert oRepoData.getAllLastSyncedCommits() == {"project_1": "d" * 40}
+
+    def test_importJson(self, tmp_path, monkeypatch):
+        sDataFolder = str(tmp_path / ".repolite")
+        os.makedirs(sDataFolder)
+        with open(os.path.join(sDataFolder, "data"), "w") as oFile:
+            json.dump({"project_1": {"last-synced-commit": "a" * 40, "I1": {"last-pushed-commit": "b" * 40},
+                                     "I2": {"last-pushed-commit": "c" * 40}},
+                       "project_2": {"I1": {"last-pushed-commit": "d" * 40}}}, oFile)
+        # Values already in the database are kept
+        RepoData(os.path.join(sDataFolder, "data.sqlite")).setLastPushedCommit("project_2", "I1", "e" * 40)
+        monkeypatch.chdir(tmp_path)
+
+        oRepoData = RepoLite(argparse.Namespace()).getRepoData()
+
+        assert oRepoData.getAllLastSyncedCommits() == {"project_1": "a" * 40}
+        assert oRepoData.getAllLastPushedCommits() == {("project_1", "I1"): "b" * 40, ("project_1", "I2"): "c" * 40,
+                                                       ("project_2", "I1"): "e" * 40}
+        assert not os.path.exists(os.path.join(sDataFolder, "data"))
+        assert os.path.isfile(os.path.join(sDataFolder, "data.bak"))
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2020 Quoc-Nam Dessoulles
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+"""Tests of the sharing of the SSH connections, with fake SSH commands"""
+
+__author__ = "Quoc-Nam Dessoulles"
+__email__ = "cokie.forever@gmail.com"
+__license__ = "MIT"
+
+import os
+import subprocess
+
+import pytest
+
+from repolite.vcs import ssh
+
+
+@pytest.mark.skipif(os.name == "nt", reason="Connection sharing is not supported on Windows")
+class TestSsh:
+    @pytest.fixture(autouse=True)
+    def setupCommands(self, tmp_path, monkeypatch):
+        self.sTmpFolder = str(tmp_path)
+        self.sLogFile = os.path.join(self.sTmpFolder, "ssh.log")
+        # Both fail after logging their name and arguments, which is enough for git
+        sBinFolder = os.path.join(self.sTmpFolder, "bin")
+        os.makedirs(sBinFolder)
+        self.writeCommand(os.path.join(sBinFolder, "ssh"), "ssh")
+        self.sCustomCommand = os.path.join(self.sTmpFolder, "custom_ssh")
+        self.writeCommand(self.sCustomCommand, "custom")
+        monkeypatch.setenv("PATH", sBinFolder + os.pathsep + os.environ["PATH"])
+        for sKey in ("GIT_SSH_COMMAND", "GIT_SSH", "GIT_SSH_VARIANT"):
+            monkeypatch.delenv(sKey, raising=False)
+
+    def writeCommand(self, sPath, sName):
+        with open(sPath, "w") as oFile:
+            oFile.write("#!/bin/sh\necho %s \"$@\" >> %s\nexit 1\n" % (sName, self.sLogFile))
+        os.chmod(sPath, 0o755)
+
+    def createRepo(self, sName):
+        sRepoFolder = os.path.join(self.sTmpFolder, sName)
+        subprocess.run(["git", "init", "-q", sRepoFolder], check=True)
+        return sRepoFolder
+
+    def lsRemote(self, sRepoFolder):
+        subprocess.run(["git", "ls-remote", "ssh://host.invalid/project"], cwd=sRepoFolder, capture_output=True)
+
+    def readLog(self):
+        with open(self.sLogFile) as oFile:
+            return oFile.read().splitlines()
+
+    def test_connectionSharing(self):
+        sRepoFolder = self.createRepo("repo")
+        sCustomRepoFolder = self.createRepo("custom_repo")
+        subprocess.run(["git", "config", "core.sshCommand", self.sCustomCommand], cwd=sCustomRepoFolder, check=True)
+
+        with ssh.connectionSharing():
+            self.lsRemote(sRepoFolder)
+            self.lsRemote(sCustomRepoFolder)
+
+        lLog = self.readLog()
+        assert len(lLog) == 2
+        assert lLog[0].startswith("ssh -o ControlMaster=auto ")
+        assert lLog[0].endswith(" host.invalid git-upload-pack '/project'")
+        # The command of the repository is used as is
+        assert lLog[1].startswith("custom ")
+        assert "ControlMaster" not in lLog[1]
+        assert lLog[1].endswith(" host.invalid git-upload-pack '/project'")
+        assert "GIT_SSH_COMMAND" not in os.environ
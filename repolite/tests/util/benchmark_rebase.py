@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2020 Quoc-Nam Dessoulles
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Benchmark of gerrit.rebase depending on the length of the topic, run it with
+python -m repolite.tests.util.benchmark_rebase"""
+
+__author__ = "Quoc-Nam Dessoulles"
+__email__ = "cokie.forever@gmail.com"
+__license__ = "MIT"
+
+import argparse
+import io
+import os
+import subprocess
+import tempfile
+import time
+from contextlib import redirect_stdout
+
+from repolite.tests.util.test_setup import configureGit, removeFolder
+from repolite.util.misc import workingDir, run
+from repolite.util.parallel import bufferedOutput
+from repolite.vcs import gerrit, git
+
+
+def legacyCherry(sUpstream, sHead="HEAD"):
+    """Original implementation of gerrit.cherry, with one "git show" per commit"""
+    for sCherry in run(["git", "cherry", sUpstream, sHead], check=True,
+                       encoding="utf-8", capture_output=True).stdout.strip().splitlines():
+        sOperation, sCommitId = sCherry.strip().split(" ", maxsplit=1)
+        if sOperation == "+":
+            sCommitBody = run(["git", "show", "-s", "--format=%b", sCommitId],
+                              check=True, encoding="utf-8", capture_output=True).stdout.strip()
+            for sBodyLine in sCommitBody.splitlines():
+                if sBodyLine.startswith("Change-Id:"):
+                    yield sCommitId, sBodyLine[len("Change-Id:"):].strip()
+                    break
+
+
+def createRepo(sFolder, iTopicLength):
+    os.makedirs(sFolder)
+    subprocess.run(["git", "init", "-q"], cwd=sFolder, check=True)
+    configureGit(sFolder)
+    with workingDir(sFolder):
+        run(["git", "commit", "-q", "--allow-empty", "-m", "Initial commit"], check=True)
+        run(["git", "branch", "target"], check=True)
+        for iIdx in range(iTopicLength):
+            with open(os.path.join(sFolder, "topic_%d.txt" % iIdx), "w") as oFile:
+                oFile.write("Topic commit %d" % iIdx)
+            run(["git", "add", "topic_%d.txt" % iIdx], check=True)
+            run(["git", "commit", "-q", "-m", "Topic commit %d\n\nChange-Id: I%040x" % (iIdx, iIdx)], check=True)
+        run(["git", "checkout", "-q", "-b", "topic"], check=True)
+        run(["git", "checkout", "-q", "target"], check=True)
+        with open(os.path.join(sFolder, "target.txt"), "w") as oFile:
+            oFile.write("Target commit")
+        run(["git", "add", "target.txt"], check=True)
+        run(["git", "commit", "-q", "-m", "Target commit"], check=True)
+
+
+def timeCherry(sFolder, xCherry, iRuns):
+    lTimes = []
+    with workingDir(sFolder), git.catFilePool():
+        for _ in range(iRuns):
+            fStartTime = time.perf_counter()
+            list(xCherry("topic", sHead="target"))
+            list(xCherry("target", sHead="topic"))
+            lTimes.append(time.perf_counter() - fStartTime)
+    return min(lTimes)
+
+
+def timeRebases(sFolder, lCherries, iRuns):
+    """Returns the best rebase time with each of the cherry implementations. The implementations are alternated within
+    each run, so that a slowdown of the machine during the benchmark affects all of them alike."""
+    lTimes = [[] for _ in lCherries]
+    xOriginalCherry = gerrit.cherry
+    try:
+        with workingDir(sFolder), git.catFilePool():
+            for _ in range(iRuns):
+                for xCherry, lCherryTimes in zip(lCherries, lTimes):
+                    gerrit.cherry = xCherry
+                    run(["git", "checkout", "-q", "-B", "rebased", "topic"], check=True)
+                    # Discards the output of git
+                    with redirect_stdout(io.StringIO()), bufferedOutput():
+                        fStartTime = time.perf_counter()
+                        gerrit.rebase("target")
+                        lCherryTimes.append(time.perf_counter() - fStartTime)
+    finally:
+        gerrit.cherry = xOriginalCherry
+    return [min(lCherryTimes) for lCherryTimes in lTimes]
+
+
+def main():
+    oParser = argparse.ArgumentParser(description="Benchmark of gerrit.rebase")
+    oParser.add_argument("lengths", help="Topic lengths to test", type=int, nargs="*", default=[10, 20, 40, 80])
+    oParser.add_argument("-r", "--runs", help="Number of runs per measure, the best one is kept", type=int, default=3)
+    oArgs = oParser.parse_args()
+
+    sRootFolder = tempfile.mkdtemp(prefix="repolite-benchmark-")
+    try:
+        # The selection is the part of the rebase looking for the commits to pick, i.e. the calls to gerrit.cherry
+        print("%8s %20s %20s %20s %20s" % ("Commits", "Selection before (s)", "Selection after (s)",
+                                           "Rebase before (s)", "Rebase after (s)"))
+        for iTopicLength in oArgs.lengths:
+            sFolder = os.path.join(sRootFolder, str(iTopicLength))
+            createRepo(sFolder, iTopicLength)
+            print("%8d %20.3f %20.3f %20.3f %20.3f" % (iTopicLength,
+                                                       timeCherry(sFolder, legacyCherry, oArgs.runs),
+                                                       timeCherry(sFolder, gerrit.cherry, oArgs.runs),
+                                                       *timeRebases(sFolder, [legacyCherry, gerrit.cherry],
+                                                                    oArgs.runs)))
+    finally:
+        removeFolder(sRootFolder)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2020 Quoc-Nam Dessoulles
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Configuration file of the tool, see the README for its format"""
+
+__author__ = "Quoc-Nam Dessoulles"
+__email__ = "cokie.forever@gmail.com"
+__license__ = "MIT"
+
+import functools
+import os
+from configparser import ConfigParser, Error as ConfigParserError
+
+from repolite.util.misc import FatalError
+
+
+def getConfigFilePath():
+    return os.path.join(os.path.expanduser("~"), ".repolite")
+
+
+class Settings:
+    """Settings of one profile of the config file, with the values of the DEFAULT profile as fallback"""
+
+    def __init__(self, sConfigFilePath, dSection):
+        self.sConfigFilePath = sConfigFilePath
+        self.dSection = dSection
+
+    def getRequired(self, sKey):
+        sValue = self.dSection.get(sKey, fallback=None)
+        if sValue is None:
+            if not os.path.isfile(self.sConfigFilePath):
+                raise FatalError("The config file %s does not exist." % self.sConfigFilePath)
+            raise FatalError("No value provided for %s in the config file" % sKey)
+        return sValue
+
+    def get(self, sKey, xDefault=None):
+        return self.getTyped("get", sKey, xDefault)
+
+    def getBool(self, sKey, bDefault=False):
+        return self.getTyped("getboolean", sKey, bDefault)
+
+    def getInt(self, sKey, iDefault=0):
+        return self.getTyped("getint", sKey, iDefault)
+
+    def getFloat(self, sKey, fDefault=0.0):
+        return self.getTyped("getfloat", sKey, fDefault)
+
+    def getTyped(self, sGetter, sKey, xDefault):
+        try:
+            return getattr(self.dSection, sGetter)(sKey, fallback=xDefault)
+        except ValueError as e:
+            raise FatalError("Invalid value for %s in the config file: %s" % (sKey, e))
+
+
+class Config:
+    """Parsed config file, with its profiles indexed by target folder"""
+
+    def __init__(self, sConfigFilePath):
+        self.sConfigFilePath = sConfigFilePath
+        self.oParser = ConfigParser()
+        try:
+            self.oParser.read(sConfigFilePath)
+        except ConfigParserError as e:
+            raise FatalError("Unable to parse the config file %s: %s" % (sConfigFilePath, e))
+
+        self.dTargets = {}
+        sConfigFolder = os.path.dirname(sConfigFilePath)
+        for sSection in self.oParser.sections():
+            sTarget = self.oParser.get(sSection, "target", fallback=None)
+            if sTarget:
+                # The first profile wins in case of duplicates, as it always did
+                self.dTargets.setdefault(normalizeFolder(os.path.join(sConfigFolder, sTarget)), sSection)
+
+    def getSettings(self, sFolder):
+        """Returns the settings of the profile targeting sFolder, or of the DEFAULT profile if there is none"""
+        sSection = self.dTargets.get(normalizeFolder(sFolder))
+        return Settings(self.sConfigFilePath, self.oParser[sSection] if sSection else self.oParser["DEFAULT"])
+
+
+def normalizeFolder(sFolder):
+    return os.path.normcase(os.path.abspath(sFolder))
+
+
+@functools.lru_cache(maxsize=None)
+def loadConfig(sConfigFilePath):
+    return Config(sConfigFilePath)
+
+
+def getConfig():
+    """Returns the config file, parsed only once per process"""
+    return loadConfig(getConfigFilePath())
+
+
+def getSettings(sFolder):
+    return getConfig().getSettings(sFolder)
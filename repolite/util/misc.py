@@ -30,9 +30,20 @@ __license__ = "MIT"
 import ctypes
 import os
 import signal
+import subprocess
+import sys
 import threading
 from contextlib import contextmanager
 
+from repolite.util.parallel import isOutputBuffered
+
+if os.name == "nt":
+    import msvcrt
+else:
+    import fcntl
+
+oThreadData = threading.local()
+
 
 class FatalError(ValueError):
     pass
@@ -65,6 +76,63 @@ def changeWorkingDir(sNewWorkingDir):
         os.chdir(sOldWorkingDir)
 
 
+@contextmanager
+def fileLock(sLockPath):
+    """Holds an exclusive lock on a file, created if needed, to serialize some work between processes"""
+    with open(sLockPath, "wb") as oFile:
+        if os.name == "nt":
+            while True:
+                try:
+                    # Only retries for 10 seconds
+                    msvcrt.locking(oFile.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    pass
+        else:
+            fcntl.flock(oFile.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if os.name == "nt":
+                msvcrt.locking(oFile.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(oFile.fileno(), fcntl.LOCK_UN)
+
+
+def getWorkingDir():
+    return getattr(oThreadData, "sWorkingDir", None) or os.path.abspath(os.getcwd())
+
+
+@contextmanager
+def workingDir(sNewWorkingDir):
+    """Thread-safe alternative to changeWorkingDir, only affecting the commands started with run()"""
+    sOldWorkingDir = getattr(oThreadData, "sWorkingDir", None)
+    oThreadData.sWorkingDir = os.path.abspath(sNewWorkingDir)
+    try:
+        yield oThreadData.sWorkingDir
+    finally:
+        oThreadData.sWorkingDir = sOldWorkingDir
+
+
+def run(lArgs, **kwargs):
+    """Same as subprocess.run, but runs in the current working dir (see workingDir) and buffers the output if needed"""
+    kwargs.setdefault("cwd", getWorkingDir())
+    bCaptureOutput = kwargs.get("capture_output") or "stdout" in kwargs or "stderr" in kwargs
+    if bCaptureOutput or not isOutputBuffered():
+        return subprocess.run(lArgs, **kwargs)
+
+    bCheck = kwargs.pop("check", False)
+    oProcess = subprocess.run(lArgs, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, **kwargs)
+    sOutput = oProcess.stdout
+    if isinstance(sOutput, bytes):
+        sOutput = sOutput.decode(sys.stdout.encoding or "utf-8", errors="replace")
+    if sOutput:
+        sys.stdout.write(sOutput)
+    if bCheck:
+        oProcess.check_returncode()
+    return oProcess
+
+
 # See https://stackoverflow.com/a/35792192
 def kill(iPid, iSignum):
     if os.name == "nt":
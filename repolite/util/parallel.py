@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2020 Quoc-Nam Dessoulles
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Parallel execution utilities"""
+
+__author__ = "Quoc-Nam Dessoulles"
+__email__ = "cokie.forever@gmail.com"
+__license__ = "MIT"
+
+import io
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+oConsoleLock = threading.RLock()
+oThreadOutput = threading.local()
+
+
+class OutputRouter:
+    """Replacement for sys.stdout sending the output of each thread to its own buffer, if it has one"""
+
+    def __init__(self, oStream):
+        self.oStream = oStream
+
+    def getTarget(self):
+        oBuffer = getattr(oThreadOutput, "oBuffer", None)
+        return oBuffer if oBuffer is not None else self.oStream
+
+    def write(self, sText):
+        return self.getTarget().write(sText)
+
+    def flush(self):
+        self.getTarget().flush()
+
+    def __getattr__(self, sName):
+        return getattr(self.oStream, sName)
+
+
+def isOutputBuffered():
+    return getattr(oThreadOutput, "oBuffer", None) is not None
+
+
+def flushOutput():
+    oBuffer = getattr(oThreadOutput, "oBuffer", None)
+    if oBuffer is not None and oBuffer.tell():
+        with oConsoleLock:
+            oStream = getattr(sys.stdout, "oStream", sys.stdout)
+            oStream.write(oBuffer.getvalue())
+            oStream.flush()
+        oBuffer.seek(0)
+        oBuffer.truncate()
+
+
+@contextmanager
+def bufferedOutput():
+    oPreviousBuffer = getattr(oThreadOutput, "oBuffer", None)
+    oThreadOutput.oBuffer = io.StringIO()
+    try:
+        yield oThreadOutput.oBuffer
+    finally:
+        flushOutput()
+        oThreadOutput.oBuffer = oPreviousBuffer
+
+
+def prompt(sMessage):
+    with oConsoleLock:
+        flushOutput()
+        oBuffer = getattr(oThreadOutput, "oBuffer", None)
+        oThreadOutput.oBuffer = None
+        try:
+            return input(sMessage)
+        finally:
+            oThreadOutput.oBuffer = oBuffer
+
+
+def runInParallel(lItems, xFunction, iJobs):
+    """Calls xFunction on every item using up to iJobs threads, and returns the results in the order of the items.
+
+    Whatever a call prints is buffered and only written to the console once the call is complete, so that the output
+    of the different calls does not get mixed up.
+    """
+    lItems = list(lItems)
+    if iJobs <= 1 or len(lItems) <= 1:
+        return [xFunction(xItem) for xItem in lItems]
+
+    def doCallFunction(xItem):
+        with bufferedOutput():
+            return xFunction(xItem)
+
+    oStdout = sys.stdout
+    sys.stdout = OutputRouter(oStdout)
+    oExecutor = ThreadPoolExecutor(max_workers=iJobs)
+    lFutures = []
+    try:
+        lFutures += [oExecutor.submit(doCallFunction, xItem) for xItem in lItems]
+        return [oFuture.result() for oFuture in lFutures]
+    except KeyboardInterrupt:
+        for oFuture in lFutures:
+            oFuture.cancel()
+        raise
+    finally:
+        oExecutor.shutdown(wait=False)
+        sys.stdout = oStdout
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2020 Quoc-Nam Dessoulles
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Asynchronous git utility functions, see the git module for the synchronous versions"""
+
+__author__ = "Quoc-Nam Dessoulles"
+__email__ = "cokie.forever@gmail.com"
+__license__ = "MIT"
+
+import asyncio
+import os
+import signal
+import subprocess
+import weakref
+
+from repolite.vcs import git
+
+MAX_PROCESSES = 32
+STREAM_CHUNK_SIZE = 64 * 1024
+STREAM_LINE_LIMIT = 1024 * 1024
+
+dSemaphores = weakref.WeakKeyDictionary()
+
+
+def runAsync(oCoroutine):
+    if os.name == "nt" and not isinstance(asyncio.get_event_loop_policy(), asyncio.WindowsProactorEventLoopPolicy):
+        # Only the proactor loop supports subprocesses on Windows, and it is not the default before Python 3.8
+        asyncio.set_event_loop_policy(asyncio.WindowsProactorEventLoopPolicy())
+    return asyncio.run(oCoroutine)
+
+
+def getForegroundTerminal():
+    """Returns the file descriptor of the terminal of stdin if this process is in its foreground, None otherwise"""
+    try:
+        if os.isatty(0) and os.tcgetpgrp(0) == os.getpgrp():
+            return 0
+    except OSError:
+        pass
+    return None
+
+
+def setForegroundProcessGroup(iTerminalFd, iProcessGroup):
+    # Background process groups get SIGTTOU when taking the terminal, unless they block it
+    signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGTTOU})
+    try:
+        os.tcsetpgrp(iTerminalFd, iProcessGroup)
+    finally:
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGTTOU})
+
+
+async def createProcess(lArgs, bCapture, **kwargs):
+    # Commands get their own process group, so that their children are killed with them and do not keep the pipes
+    # open. The commands whose output is not captured can use the terminal, so they are given its foreground in
+    # order to read it and to get Ctrl+C.
+    if os.name == "nt":
+        oProcess = await asyncio.create_subprocess_exec(*lArgs, **kwargs)
+        oProcess.iTerminalFd = None
+        oProcess.bProcessGroup = False
+        return oProcess
+    iTerminalFd = None if bCapture else getForegroundTerminal()
+
+    def setProcessGroup():
+        os.setpgrp()
+        if iTerminalFd is not None:
+            # Done by the child as well, so that it does not read the terminal before having its foreground
+            setForegroundProcessGroup(iTerminalFd, os.getpgrp())
+
+    if bCapture:
+        oProcess = await asyncio.create_subprocess_exec(*lArgs, start_new_session=True, **kwargs)
+    else:
+        oProcess = await asyncio.create_subprocess_exec(*lArgs, preexec_fn=setProcessGroup, **kwargs)
+    oProcess.iTerminalFd = iTerminalFd
+    oProcess.bProcessGroup = True
+    if iTerminalFd is not None:
+        try:
+            setForegroundProcessGroup(iTerminalFd, oProcess.pid)
+        except OSError:
+            # Already exited
+            pass
+    return oProcess
+
+
+def releaseTerminal(oProcess):
+    """Gives the foreground of the terminal back to this process once the given one is done"""
+    if oProcess.iTerminalFd is not None:
+        setForegroundProcessGroup(oProcess.iTerminalFd, os.getpgrp())
+        oProcess.iTerminalFd = None
+
+
+async def killProcess(oProcess):
+    if oProcess.returncode is None:
+        if oProcess.bProcessGroup:
+            try:
+                os.killpg(oProcess.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        else:
+            oProcess.kill()
+        await oProcess.wait()
+
+
+def getSemaphore():
+    # Semaphores are bound to the loop they are created in, so we need one per loop
+    oLoop = asyncio.get_running_loop()
+    if oLoop not in dSemaphores:
+        dSemaphores[oLoop] = asyncio.Semaphore(MAX_PROCESSES)
+    return dSemaphores[oLoop]
+
+
+async def run(lArgs, sCwd=None, bCapture=True, bMergeOutput=False, check=False, env=None):
+    """Runs a command, returns a subprocess.CompletedProcess with the decoded output if bCapture is True"""
+    xOutput = subprocess.PIPE if bCapture else None
+    async with getSemaphore():
+        oProcess = await createProcess(lArgs, bCapture, cwd=sCwd, env=env,
+                                       stdin=subprocess.DEVNULL if bCapture else None, stdout=xOutput,
+                                       stderr=subprocess.STDOUT if bMergeOutput else xOutput)
+        try:
+            bStdout, bStderr = await oProcess.communicate()
+        except asyncio.CancelledError:
+            await killProcess(oProcess)
+            raise
+        finally:
+            releaseTerminal(oProcess)
+    if oProcess.returncode == -signal.SIGINT and not bCapture:
+        # Ctrl+C only reached the command, which had the foreground of the terminal
+        raise KeyboardInterrupt()
+    sStdout = bStdout.decode("utf-8", errors="replace") if bStdout is not None else None
+    sStderr = bStderr.decode("utf-8", errors="replace") if bStderr is not None else None
+    if check and oProcess.returncode != 0:
+        raise subprocess.CalledProcessError(oProcess.returncode, lArgs, sStdout, sStderr)
+    return subprocess.CompletedProcess(lArgs, oProcess.returncode, sStdout, sStderr)
+
+
+async def stream(lArgs, xOnStdoutLine, xOnStderrLine, sCwd=None, env=None):
+    """Runs a command and calls the given functions with each line of its output as soon as it is available, returns
+    the exit code of the command"""
+    async def readLines(oStream, xOnLine):
+        bPartialLine = b""
+        while True:
+            bChunk = await oStream.read(STREAM_CHUNK_SIZE)
+            if not bChunk:
+                break
+            lLines = (bPartialLine + bChunk).split(b"\n")
+            bPartialLine = lLines.pop()
+            if len(bPartialLine) >= STREAM_LINE_LIMIT:
+                # Longer lines are split instead of being held in memory
+                lLines.append(bPartialLine)
+                bPartialLine = b""
+            for bLine in lLines:
+                xOnLine(bLine.decode("utf-8", errors="replace").rstrip("\r"))
+        if bPartialLine:
+            xOnLine(bPartialLine.decode("utf-8", errors="replace").rstrip("\r"))
+
+    async with getSemaphore():
+        oProcess = await createProcess(lArgs, True, cwd=sCwd, env=env, stdin=subprocess.DEVNULL,
+                                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        try:
+            await asyncio.gather(readLines(oProcess.stdout, xOnStdoutLine), readLines(oProcess.stderr, xOnStderrLine))
+            return await oProcess.wait()
+        except BaseException:
+            # Cancelled, e.g. on timeout
+            await killProcess(oProcess)
+            raise
+
+
+async def getFirstRemote(sCwd=None):
+    return (await run(["git", "remote"], sCwd=sCwd, check=True)).stdout.strip().splitlines()[0]
+
+
+async def getCurrentBranch(sCwd=None):
+    sBranch = git.readCurrentBranch(sCwd or os.getcwd())
+    if sBranch is not None:
+        return sBranch
+    return (await run(["git", "branch", "--show-current"], sCwd=sCwd, check=True)).stdout.strip()
+
+
+async def getLastCommitMsg(sCwd=None):
+    return (await run(["git", "log", "-1", "--format=full"], sCwd=sCwd, check=True)).stdout.strip()
+
+
+async def getAllBranches(sCwd=None):
+    return [s[2:] for s in (await run(["git", "branch"], sCwd=sCwd, check=True)).stdout.splitlines()]
+
+
+async def getGitMessages(sCwd=None):
+    return (await run(["git", "log", "--format=format:%s"], sCwd=sCwd, check=True)).stdout.splitlines()
+
+
+async def getRemoteUrl(sCwd=None):
+    sRemote = await getFirstRemote(sCwd=sCwd)
+    return (await run(["git", "config", "--get", "remote.%s.url" % sRemote], sCwd=sCwd, check=True)).stdout.strip()
+
+
+async def getLastCommit(sCwd=None):
+    return (await run(["git", "rev-parse", "HEAD"], sCwd=sCwd, check=True)).stdout.strip()
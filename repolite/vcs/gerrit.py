@@ -27,32 +27,173 @@ __author__ = "Quoc-Nam Dessoulles"
 __email__ = "cokie.forever@gmail.com"
 __license__ = "MIT"
 
+import hashlib
+import itertools
 import json
-import random
+import os
 import re
 import subprocess
+import tempfile
+import threading
+import time
 from collections import OrderedDict
-from urllib.parse import urlparse, unquote, quote
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse, unquote, quote, quote_plus
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+from repolite.util.misc import run, getWorkingDir
 from repolite.vcs import git
 
 
+class ResponseCache:
+    """On-disk cache of REST responses.
+
+    Entries younger than iTtl seconds are used as is, older ones are revalidated with their ETag if they have one.
+    The least recently used entries are removed when the total size exceeds iMaxSize bytes, until it is back under
+    EVICTION_RATIO times iMaxSize. The total size is only computed once, and then kept up to date by put.
+    """
+
+    EVICTION_RATIO = 0.8
+
+    def __init__(self, sFolder, iTtl=0, iMaxSize=50 * 1024 * 1024):
+        self.sFolder = sFolder
+        self.iTtl = iTtl
+        self.iMaxSize = iMaxSize
+        self.iSize = None
+        self.oLock = threading.Lock()
+        os.makedirs(self.sFolder, exist_ok=True)
+
+    def getFile(self, sKey):
+        return os.path.join(self.sFolder, hashlib.sha1(sKey.encode("utf-8")).hexdigest())
+
+    def get(self, sKey):
+        sFile = self.getFile(sKey)
+        try:
+            with open(sFile, "r", encoding="utf-8") as oFile:
+                dEntry = json.load(oFile)
+            os.utime(sFile)
+        except (ValueError, OSError):
+            return None
+        return dEntry if dEntry.get("key") == sKey else None
+
+    def isFresh(self, dEntry):
+        return time.time() - dEntry["time"] < self.iTtl
+
+    def put(self, sKey, sEtag, sContent):
+        sFile = self.getFile(sKey)
+        iFd, sTmpFile = tempfile.mkstemp(dir=self.sFolder, prefix=".tmp")
+        try:
+            with os.fdopen(iFd, "w", encoding="utf-8") as oFile:
+                json.dump({"key": sKey, "etag": sEtag, "time": time.time(), "content": sContent}, oFile)
+            iNewSize = os.path.getsize(sTmpFile)
+            iOldSize = os.path.getsize(sFile) if os.path.isfile(sFile) else 0
+            os.replace(sTmpFile, sFile)
+        except OSError:
+            if os.path.exists(sTmpFile):
+                os.remove(sTmpFile)
+            return
+        with self.oLock:
+            if self.iSize is not None:
+                self.iSize += iNewSize - iOldSize
+            if self.iSize is None or self.iSize > self.iMaxSize:
+                self.evict()
+
+    def evict(self):
+        # Also resynchronizes the total size, which may be changed by other processes sharing the folder
+        lEntries = []
+        for oEntry in os.scandir(self.sFolder):
+            try:
+                if oEntry.is_file() and not oEntry.name.startswith(".tmp"):
+                    oStat = oEntry.stat()
+                    lEntries.append((oStat.st_mtime, oStat.st_size, oEntry.path))
+            except OSError:
+                pass
+        iTotalSize = sum(iSize for _, iSize, _ in lEntries)
+        if iTotalSize > self.iMaxSize:
+            for _, iSize, sFile in sorted(lEntries):
+                if iTotalSize <= self.iMaxSize * self.EVICTION_RATIO:
+                    break
+                try:
+                    os.remove(sFile)
+                except OSError:
+                    pass
+                iTotalSize -= iSize
+        self.iSize = iTotalSize
+
+    def clear(self):
+        for oEntry in os.scandir(self.sFolder):
+            try:
+                os.remove(oEntry.path)
+            except OSError:
+                pass
+        with self.oLock:
+            self.iSize = 0
+
+
 class ApiClient:
-    def __init__(self, sBaseUrl, sUsername, sPassword):
+    """Client of the Gerrit REST API, meant to be shared by all the threads of the process.
+
+    The connections are kept alive in a pool of iPoolSize connections per host, and the requests failing with 429,
+    502 or 503 are retried up to iRetries times with an exponential backoff (honoring the Retry-After header). Only
+    idempotent requests are retried.
+    """
+
+    def __init__(self, sBaseUrl, sUsername, sPassword, oCache=None, iPoolSize=10, fTimeout=30, iRetries=3,
+                 fBackoffFactor=0.5):
         self.sBaseUrl = sBaseUrl
+        self.fTimeout = fTimeout
+        self.iPoolSize = iPoolSize
         self.oSession = requests.session()
         self.oSession.auth = (sUsername, sPassword)
+        oRetry = Retry(total=iRetries, backoff_factor=fBackoffFactor,
+                       status_forcelist=[429, 502, 503], raise_on_status=False)
+        oAdapter = HTTPAdapter(pool_connections=iPoolSize, pool_maxsize=iPoolSize, max_retries=oRetry)
+        self.oSession.mount("https://", oAdapter)
+        self.oSession.mount("http://", oAdapter)
+        self.oCache = oCache
 
     def url(self, sUrl):
         return "/".join([self.sBaseUrl, "a", sUrl])
 
     def request(self, sMethod, sUrl, **kwargs):
+        kwargs.setdefault("timeout", self.fTimeout or None)
+        if self.oCache is not None:
+            if sMethod == "GET":
+                return self.cachedGet(sUrl, **kwargs)
+            # We cannot know which entries are affected
+            self.oCache.clear()
         oResponse = self.oSession.request(sMethod, self.url(sUrl), **kwargs)
         oResponse.raise_for_status()
+        return self.parse(oResponse.content)
+
+    def cachedGet(self, sUrl, **kwargs):
+        sKey = " ".join([self.oSession.auth[0], self.url(sUrl), json.dumps(kwargs.get("params"), sort_keys=True)])
+        dEntry = self.oCache.get(sKey)
+        if dEntry is not None and self.oCache.isFresh(dEntry):
+            return self.parse(dEntry["content"].encode("utf-8"))
+
+        dHeaders = dict(kwargs.pop("headers", None) or {})
+        if dEntry is not None and dEntry["etag"]:
+            dHeaders["If-None-Match"] = dEntry["etag"]
+        oResponse = self.oSession.request("GET", self.url(sUrl), headers=dHeaders, **kwargs)
+        if oResponse.status_code == 304 and dEntry is not None:
+            self.oCache.put(sKey, dEntry["etag"], dEntry["content"])
+            return self.parse(dEntry["content"].encode("utf-8"))
+        oResponse.raise_for_status()
+
+        sEtag = oResponse.headers.get("ETag")
+        if sEtag or self.oCache.iTtl > 0:
+            self.oCache.put(sKey, sEtag, oResponse.content.decode("utf-8"))
+        return self.parse(oResponse.content)
+
+    @staticmethod
+    def parse(bContent):
         try:
-            return json.loads(oResponse.content[5:]) if oResponse.content else None
+            # Gerrit prefixes its JSON responses with )]}' to prevent XSSI
+            return json.loads(bContent[5:]) if bContent else None
         except ValueError:
             return None
 
@@ -75,69 +216,143 @@ class ApiClient:
             sQuery = ""
         return self.get("changes/%s~%s~%s%s" % (quote(sProject, safe=""), sBranch, sChangeId, sQuery))
 
+    def queryChanges(self, lQueries, lAdditionalData=None, iMaxQueryLength=1500):
+        """Returns the changes matching any of the queries, using as few requests as possible"""
+        lChunks = []
+        for sQuery in lQueries:
+            sQuery = quote_plus("(%s)" % sQuery)
+            if lChunks and len(lChunks[-1]) + len(sQuery) + len("+OR+") <= iMaxQueryLength:
+                lChunks[-1] += "+OR+" + sQuery
+            else:
+                lChunks.append(sQuery)
+
+        sOptions = "".join("&o=%s" % s for s in lAdditionalData or [])
+
+        def queryChunk(sChunk):
+            lChanges = []
+            iStart = 0
+            while True:
+                lResults = self.get("changes/?q=%s%s&S=%d" % (sChunk, sOptions, iStart)) or []
+                lChanges += lResults
+                iStart += len(lResults)
+                if not lResults or not lResults[-1].get("_more_changes", False):
+                    return lChanges
+
+        # The chunks are independent, so they are requested concurrently over the pooled connections
+        with ThreadPoolExecutor(max_workers=max(1, min(self.iPoolSize, len(lChunks)))) as oExecutor:
+            return [dChange for lChanges in oExecutor.map(queryChunk, lChunks) for dChange in lChanges]
+
+    def getChangesData(self, lChanges, lAdditionalData=None):
+        """Bulk version of getChangeData, lChanges being (project, branch, Change-Id) tuples.
+
+        Returns the data of the changes found, with the same tuples as keys.
+        """
+        lQueries = ['change:%s project:"%s" branch:"%s"' % (sChangeId, sProject, sBranch)
+                    for sProject, sBranch, sChangeId in OrderedDict.fromkeys(lChanges)]
+        return {(dData["project"], dData["branch"], dData["change_id"]): dData
+                for dData in self.queryChanges(lQueries, lAdditionalData=lAdditionalData)}
+
 
 def push(sTopic=None, sTargetBranch="master"):
-    sRemote = git.getFirstRemote()
+    sRemote = git.getRepoState().sFirstRemote
     lArgs = ["git", "push", sRemote, "HEAD:refs/for/%s" % sTargetBranch]
     if sTopic:
         lArgs += ["-o", "topic=%s" % sTopic]
-    subprocess.run(lArgs, check=True)
+    run(lArgs, check=True)
+
 
+def download(lPatchRefs, bDetach=False):
+    """Fetches the patches with a single fetch, and rebases the current branch on top of them, or detaches HEAD.
 
-def download(sPatchRef, bDetach=False):
-    sRemote = git.getFirstRemote()
-    subprocess.run(["git", "fetch", sRemote, sPatchRef], check=True)
-    if bDetach:
-        subprocess.run(["git", "checkout", "FETCH_HEAD", "--detach"], check=True)
-    else:
-        rebase("FETCH_HEAD")
+    Only the patches which are not already included in another one need to be applied, e.g. the last change of a
+    relation chain brings all the previous ones with it. If there are several of them, they are applied one after
+    the other, each rebase keeping the changes brought by the previous ones.
+    """
+    try:
+        lCommits = git.getIndependentCommits(git.fetchRefs(git.getFirstRemote(), lPatchRefs))
+        if bDetach:
+            run(["git", "checkout", lCommits.pop(0), "--detach"], check=True)
+        for sCommit in lCommits:
+            rebase(sCommit)
+    finally:
+        git.deleteDownloadedRefs()
 
 
 def cherry(sUpstream, sHead="HEAD"):
-    dCommits = OrderedDict()
-    for sCherry in subprocess.run(["git", "cherry", sUpstream, sHead], check=True,
-                                  encoding="utf-8", capture_output=True).stdout.strip().splitlines():
-        sOperation, sCommitId = sCherry.strip().split(" ", maxsplit=1)
-        if sOperation == "+":
-            sCommitBody = subprocess.run(["git", "show", "-s", "--format=%b", sCommitId],
-                                         check=True, encoding="utf-8", capture_output=True).stdout.strip()
-            for sBodyLine in sCommitBody.splitlines():
-                if sBodyLine.startswith("Change-Id:"):
-                    dCommits[sCommitId] = sBodyLine[len("Change-Id:"):].strip()
-                    break
-    return dCommits
+    """Yields the (commit, Change-Id) pairs of the commits of sHead without equivalent in sUpstream, oldest first.
+
+    Same as "git cherry", but everything comes from a single "git log" whose output is parsed as it arrives.
+    Commits without Change-Id are ignored.
+    """
+    # Before Git 2.23, the Change-Ids cannot be extracted by "git log", they are read with cat-file instead
+    bTrailers = git.getVersion() >= (2, 23)
+    sFormat = "%m%x00%H%x00%(trailers:key=Change-Id,valueonly,separator=%x2C)" if bTrailers else "%m%x00%H%x00"
+    lArgs = ["git", "log", "--cherry-mark", "--right-only", "--no-merges", "--reverse", "--format=%s" % sFormat,
+             "%s...%s" % (sUpstream, sHead), "--"]
+    oProcess = subprocess.Popen(lArgs, cwd=getWorkingDir(), stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                encoding="utf-8")
+    bComplete = False
+    try:
+        for sLine in oProcess.stdout:
+            sMark, sCommitId, sChangeIds = sLine.rstrip("\n").split("\0")
+            if not bTrailers and sMark != "=":
+                sChangeIds = parseChangeId(git.getCommitMsg(sCommitId)) or ""
+            # Equivalent commits are marked with "=" instead of ">"
+            if sMark != "=" and sChangeIds:
+                yield sCommitId, sChangeIds.split(",")[0].strip()
+        bComplete = True
+    finally:
+        if not bComplete:
+            oProcess.kill()
+        _, sStderr = oProcess.communicate()
+    if oProcess.returncode != 0:
+        raise subprocess.CalledProcessError(oProcess.returncode, lArgs, stderr=sStderr)
 
 
 def rebase(sTargetBranch, bIgnoreChangeIds=False):
+    """Rebases the current branch, or detached HEAD, on sTargetBranch.
+
+    If possible, the new commits are created without touching the worktree, which is then updated only once at the
+    end. The commits are otherwise cherry-picked one by one, starting from the first one which could not be picked
+    that way, and the user is asked to solve the conflicts if any.
+    """
     sCurrentBranch = git.getCurrentBranch()
-    if not sCurrentBranch:
-        sCurrentBranch = "tmp.%06d" % random.randrange(1e6)
-        subprocess.run(["git", "checkout", "-b", sCurrentBranch], check=True)
-        bDeleteBranch = True
-    else:
-        bDeleteBranch = False
-
-    subprocess.run(["git", "checkout", "--detach", sTargetBranch], check=True)
-    lChangeIds = cherry(sCurrentBranch).values() if not bIgnoreChangeIds else []
-    for sCommitIdToPick, sChangeId in cherry("HEAD", sHead=sCurrentBranch).items():
-        if sChangeId in lChangeIds:
-            continue
+    sOriginalHead = git.getLastCommit()
+    lChangeIds = {sChangeId for _, sChangeId in cherry(sOriginalHead, sHead=sTargetBranch)} \
+        if not bIgnoreChangeIds else set()
+    lCommitsToPick = (sCommitId for sCommitId, sChangeId in cherry(sTargetBranch, sHead=sOriginalHead)
+                      if sChangeId not in lChangeIds)
+
+    sNewHead = sTargetBranch
+    if git.canPickInMemory():
+        for sCommitIdToPick in lCommitsToPick:
+            sNewCommit = git.pickInMemory(sCommitIdToPick, sNewHead)
+            if sNewCommit is None:
+                lCommitsToPick = itertools.chain([sCommitIdToPick], lCommitsToPick)
+                break
+            sNewHead = sNewCommit
+
+    run(["git", "checkout", "--detach", sNewHead], check=True)
+    for sCommitIdToPick in lCommitsToPick:
         git.cherryPick(sCommitIdToPick,
-                       xOnAbort=lambda: subprocess.run(["git", "checkout", sCurrentBranch], check=True))
+                       xOnAbort=lambda: run(["git", "checkout", sCurrentBranch or sOriginalHead], check=True))
+
+    if sCurrentBranch:
+        run(["git", "checkout", "-B", sCurrentBranch], check=True)
+
 
-    if bDeleteBranch:
-        subprocess.run(["git", "branch", "-D", sCurrentBranch])
-    else:
-        subprocess.run(["git", "checkout", "-B", sCurrentBranch], check=True)
+def getChangeId(sCommit=None):
+    if sCommit is None:
+        return parseChangeId(git.getRepoState().sCommitMsg)
+    return parseChangeId(git.getCommitMsg(sCommit))
 
 
-def getChangeId():
-    sCommitMsg = git.getLastCommitMsg()
+def parseChangeId(sCommitMsg):
     oMatch = re.search(r"^\s*Change-Id:\s*(.*)", sCommitMsg, re.MULTILINE)
     return oMatch.group(1).strip() if oMatch is not None else None
 
 
 def getProjectName(sUrl=None):
     if not sUrl:
-        sUrl = git.getRemoteUrl()
+        sUrl = git.getRepoState().sRemoteUrl
     return unquote(urlparse(sUrl).path[1:])
@@ -28,54 +28,482 @@ __email__ = "cokie.forever@gmail.com"
 __license__ = "MIT"
 
 import os
+import re
 import subprocess
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import lru_cache
+from urllib.parse import urlparse, unquote
 
-from repolite.util.misc import FatalError
+from repolite.util.misc import FatalError, run, getWorkingDir, fileLock
+from repolite.util.parallel import prompt
+
+dRepoStateCache = None
+dCatFilePool = None
+dMirrorLocks = {}
+oMirrorLocksLock = threading.Lock()
+
+FETCHED_REF = "refs/repolite/fetched"
+DOWNLOADED_REFS = "refs/repolite/download/"
+
+
+class RepoState:
+    """Snapshot of the HEAD and remotes of a repository, see getRepoState"""
+
+    def __init__(self, sCommit, sBranch, sCommitMsg, dRemoteUrls):
+        self.sCommit = sCommit
+        self.sBranch = sBranch
+        self.sCommitMsg = sCommitMsg
+        self.dRemoteUrls = dRemoteUrls
+
+    @property
+    def sFirstRemote(self):
+        # Same order as "git remote"
+        return sorted(self.dRemoteUrls)[0]
+
+    @property
+    def sRemoteUrl(self):
+        return self.dRemoteUrls[self.sFirstRemote]
+
+    @classmethod
+    def load(cls, sCwd=None):
+        sOutput = run(["git", "config", "-z", "--get-regexp", r"^remote\..*\.url$"], capture_output=True,
+                      encoding="utf-8", cwd=sCwd or getWorkingDir()).stdout
+        dRemoteUrls = {}
+        for sEntry in filter(bool, sOutput.split("\0")):
+            sKey, sUrl = sEntry.split("\n", maxsplit=1)
+            dRemoteUrls[sKey[len("remote."):-len(".url")]] = sUrl
+
+        sOutput = run(["git", "log", "-1", "--format=%H%x00%D%x00%B", "HEAD"], capture_output=True,
+                      encoding="utf-8", check=True, cwd=sCwd or getWorkingDir()).stdout
+        sCommit, sDecorations, sCommitMsg = sOutput.split("\0", maxsplit=2)
+        sBranch = ""
+        for sDecoration in sDecorations.split(", "):
+            if sDecoration.startswith("HEAD -> "):
+                sBranch = sDecoration[len("HEAD -> "):]
+                break
+        return cls(sCommit, sBranch, sCommitMsg.strip(), dRemoteUrls)
+
+
+@contextmanager
+def repoStateCache():
+    """Within this context, the states returned by getRepoState are only loaded once per repository"""
+    global dRepoStateCache
+    dPreviousCache = dRepoStateCache
+    dRepoStateCache = {}
+    try:
+        yield
+    finally:
+        dRepoStateCache = dPreviousCache
+
+
+def getRepoState(sCwd=None):
+    sCwd = os.path.normcase(os.path.abspath(sCwd or getWorkingDir()))
+    if dRepoStateCache is None:
+        return RepoState.load(sCwd)
+    if sCwd not in dRepoStateCache:
+        dRepoStateCache[sCwd] = RepoState.load(sCwd)
+    return dRepoStateCache[sCwd]
+
+
+def invalidateRepoState(sCwd=None):
+    if dRepoStateCache is not None:
+        dRepoStateCache.pop(os.path.normcase(os.path.abspath(sCwd or getWorkingDir())), None)
+
+
+class CatFile:
+    """Long-lived "git cat-file --batch" process, to read many objects of a repository without starting new processes"""
+
+    def __init__(self, sCwd=None):
+        self.oProcess = subprocess.Popen(["git", "cat-file", "--batch"], cwd=sCwd or getWorkingDir(),
+                                         stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        self.oLock = threading.Lock()
+
+    def read(self, sRev):
+        """Returns the SHA-1, the type and the raw content of an object"""
+        with self.oLock:
+            try:
+                self.oProcess.stdin.write(sRev.encode("utf-8") + b"\n")
+                self.oProcess.stdin.flush()
+                sHeader = self.oProcess.stdout.readline().decode("utf-8").strip()
+            except OSError as e:
+                raise FatalError("Unable to read object %s: %s" % (sRev, e))
+            lHeader = sHeader.split(" ")
+            if len(lHeader) != 3:
+                raise FatalError("Unable to read object %s: %s" % (sRev, sHeader or "git cat-file stopped"))
+            sObject, sType, sSize = lHeader
+            bContent = self.oProcess.stdout.read(int(sSize) + 1)[:-1]
+            return sObject, sType, bContent
+
+    def close(self):
+        try:
+            self.oProcess.stdin.close()
+        except OSError:
+            pass
+        self.oProcess.wait()
+
+
+@contextmanager
+def catFilePool():
+    """Within this context, the CatFile processes returned by getCatFile are reused, one per repository, until
+    closeCatFile is called for this repository"""
+    global dCatFilePool
+    dPreviousPool = dCatFilePool
+    dCatFilePool = {}
+    try:
+        yield
+    finally:
+        for oCatFile in dCatFilePool.values():
+            oCatFile.close()
+        dCatFilePool = dPreviousPool
+
+
+@contextmanager
+def getCatFile(sCwd=None):
+    sCwd = os.path.normcase(os.path.abspath(sCwd or getWorkingDir()))
+    if dCatFilePool is None:
+        oCatFile = CatFile(sCwd)
+        try:
+            yield oCatFile
+        finally:
+            oCatFile.close()
+    else:
+        if sCwd not in dCatFilePool:
+            dCatFilePool[sCwd] = CatFile(sCwd)
+        yield dCatFilePool[sCwd]
+
+
+def closeCatFile(sCwd=None):
+    """Closes the pooled CatFile process of a repository if any, so that processes do not pile up with many repos"""
+    if dCatFilePool is not None:
+        oCatFile = dCatFilePool.pop(os.path.normcase(os.path.abspath(sCwd or getWorkingDir())), None)
+        if oCatFile is not None:
+            oCatFile.close()
+
+
+def getCommit(sRev, sCwd=None):
+    """Returns the SHA-1, the headers (name -> list of values) and the message of a commit"""
+    with getCatFile(sCwd) as oCatFile:
+        sObject, sType, bContent = oCatFile.read(sRev)
+    if sType != "commit":
+        raise FatalError("%s is not a commit" % sRev)
+    sHeaders, _, sMessage = bContent.decode("utf-8", errors="replace").partition("\n\n")
+    dHeaders = OrderedDict()
+    sName = None
+    for sLine in sHeaders.splitlines():
+        if sLine.startswith(" ") and sName is not None:
+            dHeaders[sName][-1] += "\n" + sLine[1:]
+        else:
+            sName, _, sValue = sLine.partition(" ")
+            dHeaders.setdefault(sName, []).append(sValue)
+    return sObject, dHeaders, sMessage
+
+
+def getCommitMsg(sRev, sCwd=None):
+    return getCommit(sRev, sCwd=sCwd)[2].strip()
 
 
 def getFirstRemote():
-    return subprocess.run(["git", "remote"], capture_output=True,
-                          encoding="utf-8", check=True).stdout.strip().splitlines()[0]
+    return run(["git", "remote"], capture_output=True,
+               encoding="utf-8", check=True).stdout.strip().splitlines()[0]
+
+
+class WorktreeStatus:
+    """Parsed output of "git status --porcelain=v2 --branch -z" """
+
+    def __init__(self, sOutput):
+        self.sCommit = None
+        self.sBranch = ""
+        self.tAheadBehind = None
+        self.iChanged = 0
+        self.iConflicts = 0
+        self.iUntracked = 0
+        lEntries = iter(sOutput.split("\0"))
+        for sEntry in lEntries:
+            if sEntry.startswith("# branch.oid "):
+                sCommit = sEntry[len("# branch.oid "):]
+                self.sCommit = sCommit if sCommit != "(initial)" else None
+            elif sEntry.startswith("# branch.head "):
+                sBranch = sEntry[len("# branch.head "):]
+                self.sBranch = sBranch if sBranch != "(detached)" else ""
+            elif sEntry.startswith("# branch.ab "):
+                sAhead, sBehind = sEntry[len("# branch.ab "):].split(" ")
+                self.tAheadBehind = (int(sAhead), -int(sBehind))
+            elif sEntry.startswith("1 "):
+                self.iChanged += 1
+            elif sEntry.startswith("2 "):
+                self.iChanged += 1
+                # The original path of a rename is in the next entry
+                next(lEntries, None)
+            elif sEntry.startswith("u "):
+                self.iConflicts += 1
+            elif sEntry.startswith("? "):
+                self.iUntracked += 1
+
+    @property
+    def bDirty(self):
+        return bool(self.iChanged or self.iConflicts or self.iUntracked)
+
+
+def getStatusArgs():
+    """Returns the command giving a WorktreeStatus, as fast as possible: the untracked cache avoids scanning all the
+    folders for new files. A file system monitor is not enabled here, as it starts a daemon in each repository, but
+    git uses it if the user configured core.fsmonitor."""
+    return ["git", "-c", "core.untrackedCache=true", "status", "--porcelain=v2", "--branch", "-z"]
+
+
+def readCurrentBranch(sDirPath):
+    """Reads the current branch of a repository from its HEAD file, without running git.
+
+    Returns an empty string if HEAD is detached, or None if the layout of the repository is not supported (in which
+    case git must be asked instead).
+    """
+    sGitPath = os.path.join(sDirPath, ".git")
+    try:
+        if os.path.isfile(sGitPath):
+            # Worktree or submodule, pointing to the actual git folder
+            with open(sGitPath, encoding="utf-8") as oFile:
+                sGitFile = oFile.read().strip()
+            if not sGitFile.startswith("gitdir:"):
+                return None
+            sGitPath = os.path.join(sDirPath, sGitFile[len("gitdir:"):].strip())
+        with open(os.path.join(sGitPath, "HEAD"), encoding="utf-8") as oFile:
+            sHead = oFile.read().strip()
+    except (OSError, ValueError):
+        return None
+    if sHead.startswith("ref: refs/heads/"):
+        sBranch = sHead[len("ref: refs/heads/"):]
+        # Placeholder of the reftable format, the actual HEAD is elsewhere
+        return sBranch if sBranch != ".invalid" else None
+    if re.fullmatch(r"[0-9a-f]{40}|[0-9a-f]{64}", sHead):
+        return ""
+    return None
 
 
-def getCurrentBranch():
-    return subprocess.run(["git", "branch", "--show-current"], capture_output=True,
-                          encoding="utf-8", check=True).stdout.strip()
+def getCurrentBranch(sCwd=None):
+    sBranch = readCurrentBranch(sCwd or getWorkingDir())
+    if sBranch is not None:
+        return sBranch
+    return run(["git", "branch", "--show-current"], cwd=sCwd or getWorkingDir(), capture_output=True,
+               encoding="utf-8", check=True).stdout.strip()
 
 
 def getLastCommitMsg():
-    return subprocess.run(["git", "log", "-1", "--format=full"], capture_output=True,
-                          encoding="utf-8", check=True).stdout.strip()
+    return getCommitMsg("HEAD")
 
 
 def getAllBranches():
-    return [s[2:] for s in subprocess.run(["git", "branch"], capture_output=True,
-                                          encoding="utf-8", check=True).stdout.splitlines()]
+    return [s[2:] for s in run(["git", "branch"], capture_output=True,
+                               encoding="utf-8", check=True).stdout.splitlines()]
 
 
 def getGitMessages():
-    return subprocess.run(["git", "log", "--format=format:%s"], capture_output=True,
-                          encoding="utf-8", check=True).stdout.splitlines()
+    return run(["git", "log", "--format=format:%s"], capture_output=True,
+               encoding="utf-8", check=True).stdout.splitlines()
 
 
 def getRemoteUrl():
     sRemote = getFirstRemote()
-    return subprocess.run(["git", "config", "--get", "remote.%s.url" % sRemote], capture_output=True,
-                          encoding="utf-8", check=True).stdout.strip()
+    return run(["git", "config", "--get", "remote.%s.url" % sRemote], capture_output=True,
+               encoding="utf-8", check=True).stdout.strip()
 
 
 def getLastCommit():
-    return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True,
-                          encoding="utf-8", check=True).stdout.strip()
+    return run(["git", "rev-parse", "HEAD"], capture_output=True,
+               encoding="utf-8", check=True).stdout.strip()
+
+
+class FetchProfile:
+    """Options of the fetches done by the tool, see setFetchProfile.
+
+    With protocol v2, the server only advertises the refs matching the refspecs instead of all of them (including the
+    numerous refs/changes/* of Gerrit). The negotiation tip restricts the commits the client reports having to the
+    history of the given ref(s), instead of the one of every local branch and topic.
+    """
+
+    def __init__(self, bProtocolV2=True, bTags=False, sNegotiationTip="HEAD"):
+        self.bProtocolV2 = bProtocolV2
+        self.bTags = bTags
+        self.sNegotiationTip = sNegotiationTip
+
+
+oFetchProfile = FetchProfile()
+
+
+def setFetchProfile(oProfile):
+    global oFetchProfile
+    oFetchProfile = oProfile
+
+
+def getFetchConfigArgs():
+    return ["-c", "protocol.version=2"] if oFetchProfile.bProtocolV2 else []
+
+
+def getFetchArgs():
+    lArgs = ["git"] + getFetchConfigArgs() + ["fetch"]
+    if not oFetchProfile.bTags:
+        lArgs.append("--no-tags")
+    sTip = oFetchProfile.sNegotiationTip
+    # A glob may match nothing, which is fine, but a missing ref (e.g. unborn HEAD) is an error
+    if sTip and getVersion() >= (2, 19) and (any(c in sTip for c in "*?[") or isValidCommit(sTip)):
+        lArgs.append("--negotiation-tip=%s" % sTip)
+    if getVersion() >= (2, 29):
+        lArgs.append("--no-write-fetch-head")
+    return lArgs
+
+
+def fetch(sRemote, sRef, bKeep=True, lOptions=()):
+    """Fetches sRef from sRemote according to the fetch profile.
+
+    If bKeep is True, the fetched commit is stored in FETCHED_REF rather than FETCH_HEAD, and returned.
+    """
+    run(getFetchArgs() + list(lOptions) + [sRemote, "+%s:%s" % (sRef, FETCHED_REF) if bKeep else sRef], check=True)
+    if bKeep:
+        return run(["git", "rev-parse", FETCHED_REF], capture_output=True, encoding="utf-8",
+                   check=True).stdout.strip()
+    return None
+
+
+def fetchRefs(sRemote, lRefs):
+    """Fetches all the refs from sRemote with a single fetch, according to the fetch profile, and returns their
+    commits in the same order. They are stored in DOWNLOADED_REFS followed by their index."""
+    lLocalRefs = ["%s%d" % (DOWNLOADED_REFS, iIdx) for iIdx in range(len(lRefs))]
+    run(getFetchArgs() + [sRemote] + ["+%s:%s" % tRefs for tRefs in zip(lRefs, lLocalRefs)], check=True)
+    return run(["git", "rev-parse"] + lLocalRefs, capture_output=True, encoding="utf-8",
+               check=True).stdout.split()
+
+
+def deleteDownloadedRefs():
+    """Deletes the refs written by fetchRefs, so that they do not keep old patches from being garbage collected"""
+    lRefs = run(["git", "for-each-ref", "--format=%(refname)", DOWNLOADED_REFS], capture_output=True,
+                encoding="utf-8", check=True).stdout.split()
+    if lRefs:
+        run(["git", "update-ref", "--stdin"], input="".join("delete %s\n" % sRef for sRef in lRefs),
+            encoding="utf-8", check=True)
+
+
+def getIndependentCommits(lCommits):
+    """Returns the commits which are not ancestors of any other one, in the same order and without duplicates"""
+    lCommits = list(OrderedDict.fromkeys(lCommits))
+    if len(lCommits) <= 1:
+        return lCommits
+    setIndependentCommits = set(run(["git", "merge-base", "--independent"] + lCommits, capture_output=True,
+                                    encoding="utf-8", check=True).stdout.split())
+    return [sCommit for sCommit in lCommits if sCommit in setIndependentCommits]
+
+
+def isValidCommit(sRev):
+    return run(["git", "rev-parse", "--verify", "-q", "%s^{commit}" % sRev], capture_output=True).returncode == 0
+
+
+def clone(sRepoUrl, sDirPath, lOptions=()):
+    """Clones a repository, lOptions being additional options of git clone such as --depth or --filter"""
+    run(["git", "clone"] + list(lOptions) + [sRepoUrl, sDirPath], check=True)
+
+
+def getMirrorPath(sMirrorFolder, sRepoUrl):
+    """Returns the shared object store of the host of a repository, in which all its projects are mirrored"""
+    oUrl = urlparse(sRepoUrl)
+    sHost = oUrl.hostname or "local"
+    if oUrl.port:
+        sHost += "_%d" % oUrl.port
+    return os.path.join(sMirrorFolder, re.sub(r"[^\w.-]", "_", sHost) + ".git")
+
+
+def updateMirror(sMirrorFolder, sRepoUrl):
+    """Fetches the branches of a repository into the shared object store of its host, creating it if needed, and
+    returns the path of that store. As many projects are forks of each other, their objects are stored only once."""
+    sMirrorPath = getMirrorPath(sMirrorFolder, sRepoUrl)
+    sProject = unquote(urlparse(sRepoUrl).path).strip("/")
+    if sProject.endswith(".git"):
+        sProject = sProject[:-len(".git")]
+    sNamespace = "refs/mirrors/%s" % re.sub(r"[^\w/.-]|\.(?=\.|/|$)", "_", sProject)
+    lArgs = ["git", "-c", "gc.auto=0"] + getFetchConfigArgs() + ["fetch", "-q", "--no-tags"]
+    if getVersion() >= (2, 29):
+        lArgs.append("--no-write-fetch-head")
+    # The repos of a host share its store, so the threads and processes syncing them take turns: concurrent inits
+    # and fetches race on the config and the refs of the store.
+    with oMirrorLocksLock:
+        oLock = dMirrorLocks.setdefault(sMirrorPath, threading.Lock())
+    os.makedirs(sMirrorFolder, exist_ok=True)
+    with oLock, fileLock(sMirrorPath + ".lock"):
+        if not os.path.isdir(sMirrorPath):
+            run(["git", "init", "-q", "--bare", sMirrorPath], check=True)
+            run(["git", "config", "gc.auto", "0"], cwd=sMirrorPath, check=True)
+        run(lArgs + [sRepoUrl, "+refs/heads/*:%s/heads/*" % sNamespace], cwd=sMirrorPath, check=True)
+    return sMirrorPath
+
+
+def isShallow():
+    return run(["git", "rev-parse", "--is-shallow-repository"], capture_output=True,
+               encoding="utf-8", check=True).stdout.strip() == "true"
+
+
+def hasMergeBase(sRev1, sRev2):
+    return run(["git", "merge-base", sRev1, sRev2], capture_output=True).returncode == 0
+
+
+def deepenUntilMergeBase(sRemote, sRef, sCommit, iDepth=64, iMaxTries=4):
+    """Fetches more history in a shallow repository until HEAD and sCommit (fetched from sRef of sRemote) have a
+    common ancestor, doubling the depth at each try and fetching the whole history as a last resort"""
+    for _ in range(iMaxTries):
+        if not isShallow() or hasMergeBase("HEAD", sCommit):
+            return
+        print("Fetching %d more commits from %s" % (iDepth, sRemote))
+        fetch(sRemote, sRef, bKeep=False, lOptions=["--deepen=%d" % iDepth])
+        iDepth *= 2
+    if isShallow() and not hasMergeBase("HEAD", sCommit):
+        print("Fetching the whole history from %s" % sRemote)
+        fetch(sRemote, sRef, bKeep=False, lOptions=["--unshallow"])
+
+
+@lru_cache(maxsize=None)
+def getVersion():
+    sOutput = run(["git", "--version"], capture_output=True, encoding="utf-8", check=True).stdout
+    oMatch = re.search(r"(\d+)\.(\d+)(?:\.(\d+))?", sOutput)
+    return tuple(int(s or 0) for s in oMatch.groups()) if oMatch is not None else (0, 0, 0)
+
+
+def canPickInMemory():
+    # "git merge-tree --merge-base" is only available since Git 2.40
+    return getVersion() >= (2, 40)
+
+
+def pickInMemory(sCommitId, sOnto):
+    """Cherry-picks a commit onto another one without touching the worktree nor the index.
+
+    Returns the new commit, or None if the commit cannot be picked this way (conflict, empty or merge commit),
+    in which case the usual cherry-pick should be used.
+    """
+    _, dHeaders, sMessage = getCommit(sCommitId)
+    if len(dHeaders.get("parent", [])) != 1:
+        return None
+    oProcess = run(["git", "merge-tree", "--write-tree", "--merge-base=%s" % dHeaders["parent"][0], sOnto, sCommitId],
+                   capture_output=True, encoding="utf-8")
+    if oProcess.returncode == 1:
+        return None
+    oProcess.check_returncode()
+    sTree = oProcess.stdout.splitlines()[0].strip()
+    if sTree == getCommit(sOnto)[1]["tree"][0]:
+        return None
+
+    dEnv = os.environ.copy()
+    oMatch = re.match(r"(.*) <(.*)> (\d+ [+-]\d{4})$", dHeaders["author"][0])
+    if oMatch is not None:
+        dEnv["GIT_AUTHOR_NAME"], dEnv["GIT_AUTHOR_EMAIL"] = oMatch.group(1), oMatch.group(2)
+        dEnv["GIT_AUTHOR_DATE"] = "@%s" % oMatch.group(3)
+    return run(["git", "commit-tree", sTree, "-p", sOnto], input=sMessage, env=dEnv, capture_output=True,
+               encoding="utf-8", check=True).stdout.strip()
 
 
 def cherryPick(sCommitId, xOnAbort=None):
     def onError():
         while True:
-            sInput = input("You may have merge conflicts. Fix them and press enter, or enter 'abort' now to quit: ")
+            sInput = prompt("You may have merge conflicts. Fix them and press enter, or enter 'abort' now to quit: ")
             if sInput == "abort":
                 print("Aborting.")
-                subprocess.run(["git", "cherry-pick", "--abort"])
+                run(["git", "cherry-pick", "--abort"])
                 if xOnAbort is not None:
                     xOnAbort()
                 raise FatalError("Process aborted.")
@@ -84,14 +512,14 @@ def cherryPick(sCommitId, xOnAbort=None):
                 break
 
     try:
-        subprocess.run(["git", "cherry-pick", sCommitId], check=True)
+        run(["git", "cherry-pick", sCommitId], check=True)
     except subprocess.CalledProcessError:
         onError()
         while True:
             try:
                 dEnv = os.environ.copy()
                 dEnv["GIT_EDITOR"] = "true"
-                subprocess.run(["git", "cherry-pick", "--continue"], check=True, env=dEnv)
+                run(["git", "cherry-pick", "--continue"], check=True, env=dEnv)
                 break
             except subprocess.CalledProcessError:
                 onError()
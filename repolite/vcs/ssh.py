@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2020 Quoc-Nam Dessoulles
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+"""Sharing of the SSH connections of the git commands, see connectionSharing"""
+
+__author__ = "Quoc-Nam Dessoulles"
+__email__ = "cokie.forever@gmail.com"
+__license__ = "MIT"
+
+import os
+import shlex
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+from repolite.util.misc import run
+
+CONTROL_PERSIST = 60
+SESSIONS_FILE = "sessions"
+
+
+def canShareConnections():
+    # The OpenSSH client of Windows does not support ControlMaster
+    if os.name == "nt":
+        return False
+    # The user's own SSH command is kept. This only checks the global core.sshCommand, the one of each repository is
+    # checked by the command run by git, see getSshCommand.
+    if "GIT_SSH_COMMAND" in os.environ or "GIT_SSH" in os.environ:
+        return False
+    return run(["git", "config", "--get", "core.sshCommand"], capture_output=True).returncode != 0
+
+
+def getSshCommand(sFolder):
+    # GIT_SSH_COMMAND takes precedence over core.sshCommand, so the repositories with their own one are given back to
+    # it, without sharing: it may authenticate differently, e.g. with a deploy key, and ssh would reuse the connection
+    # of another repository to the same host. Every other session is recorded before starting ssh, git adds the host
+    # and the remote command after it.
+    return 'sCommand=$(git config --get core.sshCommand) && exec sh -c "$sCommand \\"\\$@\\"" "$sCommand" "$@"; ' \
+        "echo >> %s; exec ssh -o ControlMaster=auto -o ControlPath=%s -o ControlPersist=%d" \
+        % (shlex.quote(os.path.join(sFolder, SESSIONS_FILE)), shlex.quote(os.path.join(sFolder, "%C")),
+           CONTROL_PERSIST)
+
+
+@contextmanager
+def connectionSharing(bEnabled=True):
+    """Within this context, the SSH connections opened by git are shared: the first connection to a host stays open in
+    the background and the following sessions go through it, instead of each doing its own handshake.
+
+    The connections are opened on demand by ssh itself, and closed when leaving the context, which prints how many
+    handshakes were saved. This is an estimate, as concurrent sessions may open their own connection when none is
+    established yet.
+    """
+    if not bEnabled or not canShareConnections():
+        yield
+        return
+
+    # The path of the sockets is limited to about 100 characters, the default temp folder may already be too long
+    sFolder = tempfile.mkdtemp(prefix="repolite-", dir="/tmp" if os.path.isdir("/tmp") else None)
+    dPreviousEnv = {sKey: os.environ.get(sKey) for sKey in ("GIT_SSH_COMMAND", "GIT_SSH_VARIANT")}
+    os.environ["GIT_SSH_COMMAND"] = getSshCommand(sFolder)
+    # Otherwise git runs the command once more to find out whether it supports the options of OpenSSH
+    os.environ["GIT_SSH_VARIANT"] = "ssh"
+    try:
+        yield
+    finally:
+        for sKey, sValue in dPreviousEnv.items():
+            if sValue is None:
+                os.environ.pop(sKey, None)
+            else:
+                os.environ[sKey] = sValue
+        closeConnections(sFolder)
+
+
+def closeConnections(sFolder):
+    try:
+        with open(os.path.join(sFolder, SESSIONS_FILE)) as oFile:
+            iSessions = len(oFile.readlines())
+    except OSError:
+        iSessions = 0
+    lSockets = [oEntry.path for oEntry in os.scandir(sFolder) if oEntry.name != SESSIONS_FILE]
+    for sSocket in lSockets:
+        # The host is ignored, the socket is enough to find the connection
+        run(["ssh", "-o", "ControlPath=%s" % sSocket, "-O", "exit", "repolite"], capture_output=True)
+    shutil.rmtree(sFolder, ignore_errors=True)
+    if iSessions and lSockets:
+        print("%d SSH session(s) over %d connection(s), %d handshake(s) saved"
+              % (iSessions, len(lSockets), max(iSessions - len(lSockets), 0)))